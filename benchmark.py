@@ -0,0 +1,178 @@
+import argparse
+import logging
+import os
+import pathlib
+import time
+import torch
+from PIL import Image
+from captionr.captionr_class import CaptionrConfig
+from captionr.backends import BACKENDS, EagerBackend, max_feature_error
+from captionr.clip_interrogator import Interrogator, Config
+from captionr.decode import open_image
+from captionr.sources import IMAGE_EXTENSIONS
+
+def find_images(folder: pathlib.Path, limit: int):
+    paths = []
+    for root, dirs, files in os.walk(folder.absolute()):
+        for name in sorted(files):
+            if os.path.splitext(name)[1].upper() in IMAGE_EXTENSIONS:
+                paths.append(os.path.join(root, name))
+    paths.sort()
+    return paths[:limit] if limit else paths
+
+def load_interrogator(args, **kwargs) -> Interrogator:
+    captionr_config = CaptionrConfig()
+    captionr_config.clip_flavor = True
+    captionr_config.clip_medium = True
+    captionr_config.clip_artist = True
+    base_path = os.path.dirname(os.path.abspath(__file__))
+    return Interrogator(Config(
+        clip_model_name=args.clip_model_name,
+        captionr_config=captionr_config,
+        device=args.device,
+        quiet=True,
+        data_path=os.path.join(base_path, 'data'),
+        cache_path=os.path.join(base_path, 'data'),
+        **kwargs
+    ))
+
+def bench_decode(args) -> None:
+    """Full-resolution decode + clip_preprocess versus draft decode + FastPreprocess."""
+    ci = load_interrogator(args)
+    paths = find_images(args.folder, args.limit)
+
+    def run(fast: bool):
+        ci.config.fast_decode = fast
+        features, decode_time, encode_time = [], 0.0, 0.0
+        for path in paths:
+            start = time.time()
+            if fast:
+                img = open_image(path, ci.input_size)
+            else:
+                img = Image.open(path).convert('RGB')
+            decode_time += time.time() - start
+            start = time.time()
+            features.append(ci.image_to_features(img))
+            encode_time += time.time() - start
+        return features, decode_time, encode_time
+
+    full, full_decode, full_encode = run(False)
+    fast, fast_decode, fast_encode = run(True)
+
+    same, cosine = 0, []
+    for a, b in zip(full, fast):
+        cosine.append((a.float() @ b.float().T).item())
+        same += ci.interrogate_fast('', None, max_flavors=args.max_flavors, image_features=a) == \
+            ci.interrogate_fast('', None, max_flavors=args.max_flavors, image_features=b)
+
+    n = max(1, len(paths))
+    print(f'images: {len(paths)}')
+    print(f'full decode+preprocess: {full_decode/n*1000:.1f} ms/img decode, {full_encode/n*1000:.1f} ms/img preprocess+encode')
+    print(f'fast decode+preprocess: {fast_decode/n*1000:.1f} ms/img decode, {fast_encode/n*1000:.1f} ms/img preprocess+encode')
+    if cosine:
+        print(f'feature cosine similarity: min {min(cosine):.4f}, mean {sum(cosine)/len(cosine):.4f}')
+    print(f'identical captions: {same}/{len(paths)}')
+
+def bench_beam(args) -> None:
+    """Exhaustive flavor chain (interrogate) versus bounded beam search (interrogate_beam)."""
+    ci = load_interrogator(args)
+    ci.config.captionr_config.clip_beam_width = args.beam_width
+    ci.config.captionr_config.clip_beam_candidates = args.beam_candidates
+    paths = find_images(args.folder, args.limit)
+
+    times = {'interrogate': 0.0, 'interrogate_beam': 0.0}
+    gaps = []
+    for path in paths:
+        features = ci.image_to_features(Image.open(path).convert('RGB'))
+        sims = {}
+        for method in times:
+            start = time.time()
+            prompt = getattr(ci, method)('', None, max_flavors=args.max_flavors, image_features=features)
+            times[method] += time.time() - start
+            sims[method] = ci.similarity(features, prompt)
+        gaps.append(sims['interrogate'] - sims['interrogate_beam'])
+        print(f'{os.path.basename(path)}: interrogate {sims["interrogate"]:.4f}, beam {sims["interrogate_beam"]:.4f}')
+
+    n = max(1, len(paths))
+    print(f'images: {len(paths)}')
+    for method, total in times.items():
+        print(f'{method}: {total/n*1000:.1f} ms/img')
+    if times['interrogate_beam'] > 0:
+        print(f'speedup: {times["interrogate"]/times["interrogate_beam"]:.1f}x')
+    if gaps:
+        print(f'similarity gap (interrogate - beam): mean {sum(gaps)/len(gaps):.4f}, max {max(gaps):.4f}')
+
+def bench_backend(args) -> None:
+    """Parity and CPU throughput of an exported backend against the eager open_clip model."""
+    ci = load_interrogator(args, backend=args.backend)
+    if ci.backend.name != args.backend:
+        print(f'{args.backend} backend could not be loaded, see the log above')
+        return
+    eager = EagerBackend(ci.clip_model)
+    paths = find_images(args.folder, args.limit)
+    images = torch.stack([ci.clip_preprocess(Image.open(p).convert('RGB')) for p in paths[:args.batch_size]]).to(ci.device)
+    texts = ci.tokenize(ci.flavors.labels[:args.batch_size * 8]).to(ci.device)
+
+    print(f'max normalized feature error ({args.backend} vs eager): {max_feature_error(eager, ci.backend, images, texts):.2e}')
+    for backend in [eager, ci.backend]:
+        with torch.no_grad():
+            backend.encode_image(images)  # warm-up
+            start = time.time()
+            for _ in range(args.repeat):
+                backend.encode_image(images)
+            image_rate = args.repeat * len(images) / (time.time() - start)
+            backend.encode_text(texts)
+            start = time.time()
+            for _ in range(args.repeat):
+                backend.encode_text(texts)
+            text_rate = args.repeat * len(texts) / (time.time() - start)
+        print(f'{backend.name}: {image_rate:.1f} images/s, {text_rate:.1f} prompts/s')
+
+def bench_precision(args) -> None:
+    """Memory and top-k tag agreement of int8 dynamic quantization against fp32 on CPU."""
+    args.device = 'cpu'
+    paths = find_images(args.folder, args.limit)
+    results = {}
+    for precision in ['fp32', 'int8']:
+        ci = load_interrogator(args, precision=precision)
+        tags, elapsed = [], 0.0
+        for path in paths:
+            img = Image.open(path).convert('RGB')
+            start = time.time()
+            features = ci.image_to_features(img)
+            elapsed += time.time() - start
+            tags.append(ci.flavors.rank(features, args.top_k))
+        results[precision] = (ci.model_bytes, elapsed, tags)
+        del ci
+
+    n = max(1, len(paths))
+    for precision, (model_bytes, elapsed, _) in results.items():
+        print(f'{precision}: model {model_bytes/2**20:.0f} MB, {elapsed/n*1000:.1f} ms/img image encode')
+    fp32_bytes, int8_bytes = results['fp32'][0], results['int8'][0]
+    print(f'memory saved: {(fp32_bytes-int8_bytes)/2**20:.0f} MB ({100*(1-int8_bytes/fp32_bytes):.0f}%)')
+    agreement = [len(set(a) & set(b)) / max(1, len(a)) for a, b in zip(results['fp32'][2], results['int8'][2])]
+    top1 = [a[:1] == b[:1] for a, b in zip(results['fp32'][2], results['int8'][2])]
+    if agreement:
+        print(f'top-{args.top_k} flavor agreement: {100*sum(agreement)/len(agreement):.1f}%, top-1 match: {sum(top1)}/{len(top1)}')
+
+def main() -> None:
+    parser = argparse.ArgumentParser(prog='benchmark', description='Benchmarks for captionr code paths')
+    parser.add_argument('benchmark', choices=['decode', 'beam', 'backend', 'precision'])
+    parser.add_argument('folder', type=pathlib.Path, help='Folder of jpg/png images to benchmark on')
+    parser.add_argument('--limit', type=int, default=50, help='Maximum number of images to use. (default: 50)')
+    parser.add_argument('--clip_model_name', default='ViT-L-14/openai')
+    parser.add_argument('--device', choices=['cuda', 'cpu'], default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--max_flavors', type=int, default=8)
+    parser.add_argument('--beam_width', type=int, default=4)
+    parser.add_argument('--beam_candidates', type=int, default=64)
+    parser.add_argument('--backend', choices=BACKENDS, default='onnx')
+    parser.add_argument('--batch_size', type=int, default=8)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--top_k', type=int, default=10)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    globals()[f'bench_{args.benchmark}'](args)
+
+if __name__ == "__main__":
+    main()
@@ -4,18 +4,32 @@ import logging
 from PIL import Image
 import os
 from captionr.clip_interrogator import Interrogator, Config
-from captionr.captionr_class import CaptionrConfig, Captionr
+from captionr.captionr_class import CaptionrConfig, Captionr, TEXT_CLIP_METHODS
+from captionr.admission import AdmissionController, LANE_UPLOAD, LANE_URL, Overloaded
+from captionr.backends import BACKENDS
+from captionr.cache import ResponseCache, content_key, url_key
+from captionr.decode import open_image
+from captionr.dedup import find_near_duplicates
+from captionr.sharding import ClaimQueue, parse_shard, progress, select_shard
+from captionr.sources import ArchiveCaptionWriter, IMAGE_EXTENSIONS, is_archive, iter_archives
 from tqdm import tqdm
 import sys
+import asyncio
+import json
+import time
+from typing import List
 
 # Import FastAPI and other necessary modules
-from fastapi import FastAPI, File, UploadFile, Form
-from fastapi.responses import PlainTextResponse
+from fastapi import FastAPI, File, UploadFile, Form, Depends
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 import uvicorn
 import io
 import requests
 
 config: CaptionrConfig = None
+# (connect, read) seconds, so an image URL that never answers cannot hold a request open
+DOWNLOAD_TIMEOUT = (10, 60)
 
 def init_argparse() -> argparse.ArgumentParser:
     parser = argparse.ArgumentParser(
@@ -28,7 +42,7 @@ def init_argparse() -> argparse.ArgumentParser:
         version=f"{parser.prog} version 0.0.1"
     )
     parser.add_argument('folder',
-                        help='One or more folders to scan for images. Images should be jpg/png.',
+                        help='One or more folders to scan for images, or tar/WebDataset/zip shards to stream images from. Images should be jpg/png.',
                         type=pathlib.Path,
                         nargs='*',
                         )
@@ -79,9 +93,19 @@ def init_argparse() -> argparse.ArgumentParser:
                         )
     parser.add_argument('--clip_method',
                         help='CLIP method to use',
-                        choices=['interrogate', 'interrogate_fast', 'interrogate_classic'],
+                        choices=['interrogate', 'interrogate_fast', 'interrogate_classic', 'interrogate_beam'],
                         default='interrogate_fast'
                         )
+    parser.add_argument('--clip_beam_width',
+                        help='Number of prompts kept per step by interrogate_beam. (default: 4)',
+                        type=int,
+                        default=4
+                        )
+    parser.add_argument('--clip_beam_candidates',
+                        help='Flavors kept by label score before interrogate_beam re-encodes any prompt. (default: 64)',
+                        type=int,
+                        default=64
+                        )
     parser.add_argument('--ignore_tags',
                         help='Comma separated list of tags to ignore',
                         )
@@ -128,9 +152,9 @@ def init_argparse() -> argparse.ArgumentParser:
                         action='store_true'
                         )
     parser.add_argument('--device',
-                        help='Device to use. (default: cuda)',
-                        choices=['cuda', 'cpu'],
-                        default='cuda'
+                        help='Device to use. (default: cuda, or mps/cpu when cuda is unavailable)',
+                        choices=['cuda', 'cpu', 'mps'],
+                        default=CaptionrConfig.device
                         )
     parser.add_argument('--extension',
                         help='Caption file extension. (default: txt)',
@@ -156,8 +180,129 @@ def init_argparse() -> argparse.ArgumentParser:
                         type=int,
                         default=8200
                         )
+    parser.add_argument('--archive_output',
+                        help='Where captions for tar/zip members go: sidecar files under <output>/<shard name>/ or a companion <shard name>.captions.tar. (default: sidecar)',
+                        choices=['sidecar', 'shard'],
+                        default='sidecar'
+                        )
+    parser.add_argument('--archive_workers',
+                        help='Number of tar/zip shards read and decoded in parallel. (default: 4)',
+                        type=int,
+                        default=4
+                        )
+    parser.add_argument('--fast_decode',
+                        help='Decode JPEG/PNG at reduced resolution near the CLIP input size and preprocess batches into a reusable buffer',
+                        action='store_true'
+                        )
+    parser.add_argument('--backend',
+                        help='Inference backend for the CLIP encoders. Exported graphs are cached next to the label caches. (default: eager)',
+                        choices=BACKENDS,
+                        default='eager'
+                        )
+    parser.add_argument('--precision',
+                        help='Model precision. int8 applies dynamic quantization to the transformer linear layers and needs --device cpu. (default: fp16 on cuda, fp32 otherwise)',
+                        choices=['fp32', 'fp16', 'int8'],
+                        )
+    parser.add_argument('--image_only',
+                        help='Free the CLIP text encoder once the label tables are built. Only interrogate_fast and interrogate_classic can be used.',
+                        action='store_true'
+                        )
+    parser.add_argument('--dedup',
+                        help='Find near-duplicate images with a perceptual hash and reuse one CLIP result per cluster',
+                        action='store_true'
+                        )
+    parser.add_argument('--dedup_threshold',
+                        help='Maximum differing bits (of 64) for two images to count as near-duplicates. (default: 4)',
+                        type=int,
+                        default=4
+                        )
+    parser.add_argument('--shard',
+                        help='Only caption shard i of N (0-based, e.g. 2/8) of the sorted image and archive list, for splitting a run across nodes',
+                        type=parse_shard
+                        )
+    parser.add_argument('--claim_dir',
+                        help='Shared directory through which nodes claim batches of images (work stealing). Every node must see the same folders.',
+                        type=pathlib.Path
+                        )
+    parser.add_argument('--claim_batch',
+                        help='Images per claimed batch with --claim_dir. (default: 64)',
+                        type=int,
+                        default=64
+                        )
+    parser.add_argument('--claim_timeout',
+                        help='Seconds without progress after which another node takes over a claimed batch. (default: 600)',
+                        type=float,
+                        default=600
+                        )
+    parser.add_argument('--shard_status',
+                        help='Print the merged progress of all nodes recorded in --claim_dir and exit',
+                        action='store_true'
+                        )
+    parser.add_argument('--batch_size',
+                        help='Maximum number of images encoded together by /caption/batch. (default: 8)',
+                        type=int,
+                        default=8
+                        )
+    parser.add_argument('--cache_size',
+                        help='Maximum number of API responses kept in the response cache, 0 disables it. (default: 1024)',
+                        type=int,
+                        default=1024
+                        )
+    parser.add_argument('--cache_ttl',
+                        help='Seconds a cached API response stays valid. (default: 3600)',
+                        type=float,
+                        default=3600
+                        )
+    parser.add_argument('--cache_max_mb',
+                        help='Memory bound of the response cache in megabytes. (default: 64)',
+                        type=float,
+                        default=64
+                        )
+    parser.add_argument('--queue_depth',
+                        help='Maximum API requests waiting for the model; more are rejected with 429. 0 disables admission control. (default: 64)',
+                        type=int,
+                        default=64
+                        )
+    parser.add_argument('--request_deadline',
+                        help='Seconds an API request may wait for the model before it is rejected (503) or dropped. (default: 30)',
+                        type=float,
+                        default=30
+                        )
+    parser.add_argument('--priority_lanes',
+                        help='Serve uploaded images ahead of image_url requests when the queue is backed up',
+                        action='store_true'
+                        )
+    parser.add_argument('--inference_workers',
+                        help='Number of API requests run on the model concurrently. (default: 1)',
+                        type=int,
+                        default=1
+                        )
     return parser
 
+def overloaded_response(e: Overloaded) -> JSONResponse:
+    return JSONResponse({"error": e.reason}, status_code=e.status_code, headers={"Retry-After": str(e.retry_after)})
+
+def decode_image(contents: bytes, size: int = None) -> Image.Image:
+    return open_image(io.BytesIO(contents), size)
+
+def download(image_url: str) -> bytes:
+    response = requests.get(image_url, timeout=DOWNLOAD_TIMEOUT)
+    response.raise_for_status()
+    return response.content
+
+def fetch_image(image_url: str, size: int = None) -> Image.Image:
+    return decode_image(download(image_url), size)
+
+def fetch_etag(image_url: str) -> str:
+    # A HEAD request is enough to recognise an unchanged URL without downloading it again
+    try:
+        response = requests.head(image_url, allow_redirects=True, timeout=10)
+        if response.ok:
+            return response.headers.get('ETag')
+    except requests.RequestException:
+        logging.debug(f'HEAD {image_url} failed, falling back to content hashing.')
+    return None
+
 def main() -> None:
     global config
     parser = init_argparse()
@@ -171,14 +316,31 @@ def main() -> None:
     else:
         logging.basicConfig(level=logging.INFO)
 
-    # Load the CLIP model
-    if config.clip_artist or config.clip_flavor or config.clip_medium \
+    if config.shard_status:
+        if config.claim_dir is None:
+            parser.error('--shard_status requires --claim_dir.')
+        print(json.dumps(progress(str(config.claim_dir)), indent=2))
+        return
+
+    if config.shard is not None and config.claim_dir is not None:
+        parser.error('--shard and --claim_dir are alternatives; use one of them.')
+
+    if config.image_only and config.clip_method in TEXT_CLIP_METHODS:
+        parser.error(f'--clip_method {config.clip_method} needs the text encoder and cannot be used with --image_only.')
+
+    # Load the CLIP model. The API always loads it so that requests can enable categories per call.
+    if config.serve_api or config.clip_artist or config.clip_flavor or config.clip_medium \
             or config.clip_movement or config.clip_trending:
         logging.info("Loading CLIP Model...")
         config._clip = Interrogator(Config(
             clip_model_name=config.clip_model_name,
             captionr_config=config,
+            device=config.device,
             quiet=config.quiet,
+            fast_decode=config.fast_decode,
+            backend=config.backend,
+            precision=config.precision,
+            image_only=config.image_only,
             data_path=os.path.join(config.base_path, 'data'),
             cache_path=os.path.join(config.base_path, 'data')
         ))
@@ -188,28 +350,201 @@ def main() -> None:
     if config.serve_api:
         # Serve the API using FastAPI
         app = FastAPI()
+        cache = None
+        if config.cache_size > 0:
+            cache = ResponseCache(max_entries=config.cache_size, ttl=config.cache_ttl,
+                                  max_bytes=int(config.cache_max_mb * 1024 * 1024))
+
+        admission = AdmissionController(max_queue=config.queue_depth, deadline=config.request_deadline,
+                                        workers=config.inference_workers, priorities=config.priority_lanes)
+        app.add_event_handler("startup", admission.start)
+        app.add_event_handler("shutdown", admission.stop)
+
+        @app.get("/admission/stats")
+        async def admission_stats():
+            return admission.stats()
+
+        @app.get("/cache/stats")
+        async def cache_stats():
+            if cache is None:
+                return {"enabled": False}
+            return {"enabled": True, **cache.stats()}
+
+        def caption_options(
+            clip_method: str = Form(None),
+            clip_max_flavors: int = Form(None),
+            clip_flavor: bool = Form(None),
+            clip_artist: bool = Form(None),
+            clip_medium: bool = Form(None),
+            clip_movement: bool = Form(None),
+            clip_trending: bool = Form(None),
+            ignore_tags: str = Form(None),
+            cap_length: int = Form(None),
+            uniquify_tags: bool = Form(None)
+        ):
+            # Form fields omitted from a request fall back to the server's command line options
+            return dict(clip_method=clip_method, clip_max_flavors=clip_max_flavors,
+                        clip_flavor=clip_flavor, clip_artist=clip_artist, clip_medium=clip_medium,
+                        clip_movement=clip_movement, clip_trending=clip_trending,
+                        ignore_tags=ignore_tags, cap_length=cap_length, uniquify_tags=uniquify_tags)
 
         @app.post("/caption")
         async def generate_caption(
             file: UploadFile = File(None),
-            image_url: str = Form(None)
+            image_url: str = Form(None),
+            deadline: float = Form(None),
+            overrides: dict = Depends(caption_options)
         ):
+            received = time.monotonic()
+            # A request may ask for less time than --request_deadline, never more
+            deadline = min(deadline, config.request_deadline) if deadline is not None else config.request_deadline
+            lane = LANE_UPLOAD if file else LANE_URL
             try:
+                # Without a cache every request needs the model, so shed it before reading or downloading anything
+                if cache is None:
+                    admission.check(deadline)
+                options = cptr.request_options(**overrides)
+                contents = None
                 if file:
                     contents = await file.read()
-                    img = Image.open(io.BytesIO(contents)).convert('RGB')
+                    key = content_key(contents, options)
                 elif image_url:
-                    response = requests.get(image_url)
-                    img = Image.open(io.BytesIO(response.content)).convert('RGB')
+                    etag = await run_in_threadpool(fetch_etag, image_url) if cache is not None else None
+                    if etag:
+                        key = url_key(image_url, etag, options)
+                    else:
+                        contents = await run_in_threadpool(download, image_url)
+                        key = content_key(contents, options)
                 else:
                     return {"error": "No image provided."}
 
-                caption = cptr.process_img_api(img)
+                async def compute():
+                    # Cached and coalesced responses never get here, so only model work is shed
+                    admission.check(deadline - (time.monotonic() - received))
+                    if contents is None:
+                        img = await run_in_threadpool(fetch_image, image_url, cptr.decode_size())
+                    else:
+                        img = await run_in_threadpool(decode_image, contents, cptr.decode_size())
+                    remaining = deadline - (time.monotonic() - received)
+                    return await admission.submit(cptr.process_img_api, img, None, options, lane=lane, deadline=remaining)
+
+                if cache is None:
+                    caption = await compute()
+                else:
+                    caption = await cache.get_or_compute(key, compute)
                 return PlainTextResponse(caption)
+            except Overloaded as e:
+                logging.warning(f"Rejected /caption request: {e.reason}")
+                return overloaded_response(e)
             except Exception as e:
                 logging.exception("Error processing image.")
                 return {"error": str(e)}
 
+        @app.post("/caption/batch")
+        async def generate_caption_batch(
+            files: List[UploadFile] = File(None),
+            image_urls: List[str] = Form(None),
+            deadline: float = Form(None),
+            overrides: dict = Depends(caption_options)
+        ):
+            received = time.monotonic()
+            deadline = min(deadline, config.request_deadline) if deadline is not None else config.request_deadline
+            try:
+                if cache is None:
+                    admission.check(deadline)
+                options = cptr.request_options(**overrides)
+            except Overloaded as e:
+                logging.warning(f"Rejected /caption/batch request: {e.reason}")
+                return overloaded_response(e)
+            except ValueError as e:
+                return {"error": str(e)}
+            # Uploads are read up front: the form is closed once this handler returns,
+            # while decoding and captioning happen inside the streamed response.
+            items = []
+            for file in files or []:
+                items.append((file.filename, await file.read()))
+            for image_url in image_urls or []:
+                items.append((image_url, image_url))
+            if not items:
+                return {"error": "No image provided."}
+
+            queued = []  # (img, lane, future) for images waiting for the model
+            arrived = asyncio.Event()
+
+            async def caption_item(index, source, item):
+                # Returns the NDJSON line for one image
+                result = {"index": index, "source": source}
+                computed = False
+
+                async def compute():
+                    nonlocal computed
+                    computed = True
+                    admission.check(deadline - (time.monotonic() - received))
+                    img = await run_in_threadpool(decode_image, contents, cptr.decode_size())
+                    future = asyncio.get_running_loop().create_future()
+                    queued.append((img, LANE_URL if isinstance(item, str) else LANE_UPLOAD, future))
+                    arrived.set()
+                    return await future
+
+                try:
+                    contents = await run_in_threadpool(download, item) if isinstance(item, str) else item
+                    if cache is None:
+                        result["caption"] = await compute()
+                    else:
+                        # Identical images, in this batch or in concurrent requests, share one model run
+                        result["caption"] = await cache.get_or_compute(content_key(contents, options), compute)
+                        if not computed:
+                            result["cached"] = True
+                except Overloaded as e:
+                    logging.warning(f"Rejected /caption/batch image {source}: {e.reason}")
+                    result.update(error=e.reason, retry_after=e.retry_after)
+                except Exception as e:
+                    logging.exception(f"Error processing {source}.")
+                    result["error"] = str(e)
+                return json.dumps(result) + "\n"
+
+            async def run_batch(batch):
+                lane = LANE_URL if any(item_lane == LANE_URL for _, item_lane, _ in batch) else LANE_UPLOAD
+                try:
+                    captions = await admission.submit(cptr.process_imgs_api, [img for img, _, _ in batch], options,
+                                                      lane=lane, deadline=deadline - (time.monotonic() - received))
+                except Exception as e:
+                    # Shed, or the batched encode itself failed: every image in the batch shares the error
+                    captions = [e] * len(batch)
+                for (_, _, future), caption in zip(batch, captions):
+                    if future.cancelled():
+                        continue
+                    if isinstance(caption, Exception):
+                        future.set_exception(caption)
+                    else:
+                        future.set_result(caption)
+
+            async def batcher():
+                # A batch runs as soon as any image is waiting; images that finish loading while
+                # it runs are collected into the next one, up to --batch_size at a time.
+                while True:
+                    await arrived.wait()
+                    arrived.clear()
+                    while queued:
+                        batch = queued[:config.batch_size]
+                        del queued[:config.batch_size]
+                        await run_batch(batch)
+
+            async def stream():
+                # Results are streamed in the order images finish, so one slow
+                # download does not hold back the results of the others.
+                tasks = [asyncio.ensure_future(caption_item(index, source, item)) for index, (source, item) in enumerate(items)]
+                batches = asyncio.ensure_future(batcher())
+                try:
+                    for finished in asyncio.as_completed(tasks):
+                        yield await finished
+                finally:
+                    batches.cancel()
+                    for task in tasks:
+                        task.cancel()
+
+            return StreamingResponse(stream(), media_type="application/x-ndjson")
+
         uvicorn.run(app, host=config.host, port=config.port)
     else:
         if len(config.folder) == 0:
@@ -225,19 +560,97 @@ def main() -> None:
         if config.preview:
             logging.info('PREVIEW MODE ENABLED. No caption files will be written.')
 
-        paths = []
+        def needs_caption(path):
+            cap_file = os.path.join(os.path.dirname(path), os.path.splitext(os.path.basename(path))[0] + f'.{config.extension}')
+            if config.existing == 'skip' and os.path.exists(cap_file):
+                if not config.quiet:
+                    logging.info(f'Caption file {cap_file} exists. Skipping.')
+                return False
+            return True
+
+        def caption_paths(paths, heartbeat=None):
+            duplicates = {}
+            reused = cptr.reused
+            if config.dedup and paths:
+                logging.info('Hashing images for near-duplicate detection...')
+                duplicates = find_near_duplicates(paths, config.dedup_threshold)
+                logging.info(f'{len(duplicates)} of {len(paths)} images are near-duplicates of another image.')
+
+            failed = 0
+            for path in tqdm(paths):
+                if cptr.process_img(path, reuse_from=duplicates.get(path)) is None:
+                    failed += 1
+                if heartbeat is not None:
+                    heartbeat()
+
+            if config.dedup and paths:
+                logging.info(f'Near-duplicate reuse saved {cptr.reused - reused} of {len(paths)} model invocations.')
+            return len(paths) - failed, failed
+
+        def caption_archives(archives, heartbeat=None):
+            processed, failed, samples = 0, 0, 0
+            writer = ArchiveCaptionWriter(config.output, config.extension, config.archive_output)
+            try:
+                for sample, img, error in tqdm(iter_archives(archives, config.extension, config.archive_workers, decode=lambda data: decode_image(data, cptr.decode_size())), desc='Shards'):
+                    samples += 1
+                    if heartbeat is not None:
+                        heartbeat()
+                    if error is not None:
+                        logging.error(f'Could not decode {sample.archive}:{sample.name}: {error}')
+                        failed += 1
+                        continue
+                    if config.existing == 'skip' and (sample.existing_caption or
+                            (config.archive_output == 'sidecar' and os.path.exists(writer.sidecar_path(sample)))):
+                        if not config.quiet:
+                            logging.info(f'Caption for {sample.archive}:{sample.name} exists. Skipping.')
+                        continue
+                    with img:
+                        if cptr.process_sample(sample, img, writer) is None:
+                            failed += 1
+                        else:
+                            processed += 1
+            finally:
+                writer.close()
+            return processed, failed, samples
+
+        # Existing captions are checked only after sharding: other nodes write captions while this
+        # one starts, and the shard/batch split must not depend on when a node scanned the folders.
+        images = []
+        archives = []
         for folder in config.folder:
+            if is_archive(folder):
+                archives.append(folder)
+                continue
             for root, dirs, files in os.walk(folder.absolute(), topdown=False):
                 for name in files:
-                    if os.path.splitext(os.path.basename(name))[1].upper() not in ['.JPEG', '.JPG', '.JPE', '.PNG']:
+                    if os.path.splitext(os.path.basename(name))[1].upper() not in IMAGE_EXTENSIONS:
                         continue
-                    cap_file = os.path.join(os.path.dirname(os.path.join(root, name)), os.path.splitext(os.path.basename(name))[0] + f'.{config.extension}')
-                    if not config.existing == 'skip' or not os.path.exists(cap_file):
-                        paths.append(os.path.join(root, name))
-                    elif not config.quiet:
-                        logging.info(f'Caption file {cap_file} exists. Skipping.')
-        for path in tqdm(paths):
-            cptr.process_img(path)
+                    images.append(os.path.join(root, name))
+
+        if config.shard is not None:
+            index, count = config.shard
+            images = select_shard(images, index, count)
+            archives = select_shard(archives, index, count)
+            logging.info(f'Shard {index}/{count}: {len(images)} images and {len(archives)} archives.')
+
+        if config.claim_dir is not None:
+            claims = ClaimQueue(str(config.claim_dir), images, config.claim_batch, config.claim_timeout,
+                                archives=[str(archive) for archive in archives])
+            for batch, batch_paths in claims:
+                logging.info(f'Claimed batch {batch + 1}/{len(claims.batches)}.')
+                heartbeat = lambda: claims.heartbeat(batch)
+                if claims.is_archive(batch):
+                    processed, failed, samples = caption_archives(batch_paths, heartbeat=heartbeat)
+                    claims.complete(batch, processed, failed, images=samples)
+                else:
+                    processed, failed = caption_paths([p for p in batch_paths if needs_caption(p)], heartbeat=heartbeat)
+                    claims.complete(batch, processed, failed)
+            summary = progress(str(config.claim_dir))
+            logging.info(f'All {summary["batches"]} batches done: {summary["processed"]} captioned, {summary["failed"]} failed across {len(summary["nodes"])} nodes.')
+        else:
+            caption_paths([p for p in images if needs_caption(p)])
+            if archives:
+                caption_archives(archives)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,118 @@
+import asyncio
+import itertools
+import math
+import time
+from fastapi.concurrency import run_in_threadpool
+
+# Priority lanes; lower runs first
+LANE_UPLOAD = 0
+LANE_URL = 1
+
+class Overloaded(Exception):
+    """Raised when a request is shed instead of queued; maps to an HTTP status with Retry-After."""
+    def __init__(self, status_code: int, retry_after: float, reason: str) -> None:
+        super().__init__(reason)
+        self.status_code = status_code
+        self.retry_after = max(1, int(math.ceil(retry_after)))
+        self.reason = reason
+
+class AdmissionController:
+    """Bounded inference queue in front of the model.
+
+    Requests are rejected up front when the queue is full (429) or when the expected wait,
+    estimated from a moving average of recent service times, would already overrun their
+    deadline (503). Requests whose deadline passes while they wait are dropped before they
+    reach the model. With priorities on, uploads are served before URL requests.
+    """
+    def __init__(self, max_queue: int = 64, deadline: float = 30.0, workers: int = 1, priorities: bool = False) -> None:
+        self.max_queue = max_queue
+        self.deadline = deadline
+        self.workers = max(1, workers)
+        self.priorities = priorities
+        self.service_time = 1.0  # seconds per job, exponentially averaged
+        self.queue = None
+        self.tasks = []
+        self.busy = 0
+        self.sequence = itertools.count()
+        self.accepted = 0
+        self.rejected_full = 0
+        self.rejected_deadline = 0
+        self.expired = 0
+        self.completed = 0
+
+    async def start(self) -> None:
+        # Created here so the queue belongs to the server's event loop
+        self.queue = asyncio.PriorityQueue()
+        self.tasks = [asyncio.ensure_future(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self) -> None:
+        for task in self.tasks:
+            task.cancel()
+        self.tasks = []
+
+    def expected_wait(self) -> float:
+        waiting = (self.queue.qsize() if self.queue is not None else 0) + self.busy
+        return (waiting + 1) * self.service_time / self.workers
+
+    def check(self, deadline: float = None) -> float:
+        """Raise Overloaded if a new request would be shed; otherwise return its absolute deadline."""
+        deadline = deadline if deadline is not None else self.deadline
+        if self.max_queue <= 0 or self.queue is None:
+            return time.monotonic() + deadline
+        wait = self.expected_wait()
+        if self.queue is not None and self.queue.qsize() >= self.max_queue:
+            self.rejected_full += 1
+            raise Overloaded(429, wait, f'Inference queue is full ({self.max_queue} waiting).')
+        if wait > deadline:
+            self.rejected_deadline += 1
+            raise Overloaded(503, wait - deadline, f'Expected wait {wait:.1f}s exceeds the {deadline:.1f}s deadline.')
+        return time.monotonic() + deadline
+
+    async def submit(self, fn, *args, lane: int = LANE_UPLOAD, deadline: float = None):
+        """Run fn(*args) in the threadpool once a worker is free, subject to admission control."""
+        if self.max_queue <= 0 or self.queue is None:
+            return await run_in_threadpool(fn, *args)
+        expires = self.check(deadline)
+        future = asyncio.get_running_loop().create_future()
+        self.queue.put_nowait((lane if self.priorities else LANE_UPLOAD, next(self.sequence), expires, future, fn, args))
+        self.accepted += 1
+        return await future
+
+    async def _worker(self) -> None:
+        while True:
+            _, _, expires, future, fn, args = await self.queue.get()
+            if future.cancelled():
+                continue  # client went away while queued
+            if time.monotonic() > expires:
+                self.expired += 1
+                future.set_exception(Overloaded(503, self.service_time, 'Request deadline passed while queued.'))
+                continue
+            self.busy += 1
+            start = time.monotonic()
+            try:
+                result = await run_in_threadpool(fn, *args)
+                if not future.cancelled():
+                    future.set_result(result)
+            except Exception as e:
+                if not future.cancelled():
+                    future.set_exception(e)
+            finally:
+                self.busy -= 1
+                self.completed += 1
+                self.service_time = 0.8 * self.service_time + 0.2 * (time.monotonic() - start)
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.max_queue > 0,
+            "queued": self.queue.qsize() if self.queue is not None else 0,
+            "busy": self.busy,
+            "max_queue": self.max_queue,
+            "deadline": self.deadline,
+            "priorities": self.priorities,
+            "service_time": self.service_time,
+            "accepted": self.accepted,
+            "completed": self.completed,
+            "rejected_full": self.rejected_full,
+            "rejected_deadline": self.rejected_deadline,
+            "expired": self.expired,
+        }
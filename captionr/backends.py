@@ -0,0 +1,193 @@
+import logging
+import os
+import time
+import torch
+
+BACKENDS = ['eager', 'torchscript', 'compile', 'onnx']
+
+class TextEncoderReleased(RuntimeError):
+    pass
+
+class _ImageEncoder(torch.nn.Module):
+    def __init__(self, clip_model) -> None:
+        super().__init__()
+        self.clip_model = clip_model
+
+    def forward(self, images):
+        return self.clip_model.encode_image(images)
+
+class _TextEncoder(torch.nn.Module):
+    def __init__(self, clip_model) -> None:
+        super().__init__()
+        self.clip_model = clip_model
+
+    def forward(self, text):
+        return self.clip_model.encode_text(text)
+
+class EagerBackend:
+    """Runs the open_clip model as is. Every backend exposes the same encode_image/encode_text
+    pair, so it can stand in for the model wherever the model was used for inference."""
+    name = 'eager'
+
+    def __init__(self, clip_model) -> None:
+        self.clip_model = clip_model
+
+    def encode_image(self, images: torch.Tensor) -> torch.Tensor:
+        return self.clip_model.encode_image(images)
+
+    def encode_text(self, text: torch.Tensor) -> torch.Tensor:
+        return self.clip_model.encode_text(text)
+
+class TorchScriptBackend(EagerBackend):
+    name = 'torchscript'
+
+    def __init__(self, clip_model, image_example, text_example, artifact_prefix: str) -> None:
+        super().__init__(clip_model)
+        self.dtype = image_example.dtype
+        self.image_encoder = self._load_or_trace(_ImageEncoder(clip_model), image_example, f'{artifact_prefix}_image.torchscript.pt')
+        self.text_encoder = None
+        if text_example is not None:
+            self.text_encoder = self._load_or_trace(_TextEncoder(clip_model), text_example, f'{artifact_prefix}_text.torchscript.pt')
+
+    def _load_or_trace(self, module, example, path: str):
+        device = example.device
+        if os.path.exists(path):
+            logging.info(f'Loading TorchScript encoder {path}')
+            return torch.jit.load(path, map_location=device).eval()
+        logging.info(f'Tracing TorchScript encoder to {path}')
+        with torch.no_grad():
+            traced = torch.jit.trace(module, example, check_trace=False)
+        traced = torch.jit.freeze(traced.eval())
+        torch.jit.save(traced, path)
+        return traced
+
+    def encode_image(self, images: torch.Tensor) -> torch.Tensor:
+        # traced graphs do not pick up autocast, so match the weights' precision up front
+        return self.image_encoder(images.to(self.dtype))
+
+    def encode_text(self, text: torch.Tensor) -> torch.Tensor:
+        return self.text_encoder(text)
+
+class CompileBackend(EagerBackend):
+    # torch.compile keeps its own on-disk kernel cache, so there is no artifact to manage here
+    name = 'compile'
+
+    def __init__(self, clip_model, text: bool = True) -> None:
+        super().__init__(clip_model)
+        if not hasattr(torch, 'compile'):
+            raise RuntimeError('--backend compile requires torch 2.0 or newer')
+        self.image_encoder = torch.compile(_ImageEncoder(clip_model), dynamic=True)
+        self.text_encoder = torch.compile(_TextEncoder(clip_model), dynamic=True) if text else None
+
+    def encode_image(self, images: torch.Tensor) -> torch.Tensor:
+        return self.image_encoder(images)
+
+    def encode_text(self, text: torch.Tensor) -> torch.Tensor:
+        return self.text_encoder(text)
+
+class OnnxBackend(EagerBackend):
+    name = 'onnx'
+
+    def __init__(self, clip_model, image_example, text_example, artifact_prefix: str, threads: int = 0) -> None:
+        super().__init__(clip_model)
+        try:
+            import onnxruntime
+        except ImportError:
+            raise RuntimeError('--backend onnx requires the onnxruntime package (pip install onnxruntime)')
+        if image_example.device.type != 'cpu':
+            raise RuntimeError('--backend onnx only serves CPU inference, use --device cpu')
+        self.device = image_example.device
+        self.dtype = image_example.dtype
+        self.threads = threads
+        self.image_session = self._load_or_export(onnxruntime, _ImageEncoder(clip_model), image_example, f'{artifact_prefix}_image.onnx')
+        self.text_session = None
+        if text_example is not None:
+            self.text_session = self._load_or_export(onnxruntime, _TextEncoder(clip_model), text_example, f'{artifact_prefix}_text.onnx')
+
+    def _load_or_export(self, onnxruntime, module, example, path: str):
+        if not os.path.exists(path):
+            logging.info(f'Exporting ONNX encoder to {path}')
+            with torch.no_grad():
+                torch.onnx.export(module, (example,), path,
+                                  input_names=['input'], output_names=['features'],
+                                  dynamic_axes={'input': {0: 'batch'}, 'features': {0: 'batch'}},
+                                  opset_version=14, do_constant_folding=True)
+        options = onnxruntime.SessionOptions()
+        if self.threads:
+            options.intra_op_num_threads = self.threads
+        # The first session saves its optimized graph next to the export so later starts can skip optimization
+        optimized_path = path[:-len('.onnx')] + '.opt.onnx'
+        if os.path.exists(optimized_path):
+            logging.info(f'Loading ONNX encoder {optimized_path}')
+            options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_DISABLE_ALL
+            return onnxruntime.InferenceSession(optimized_path, options, providers=['CPUExecutionProvider'])
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.optimized_model_filepath = optimized_path
+        return onnxruntime.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+
+    def _run(self, session, value: torch.Tensor) -> torch.Tensor:
+        outputs = session.run(None, {'input': value.cpu().numpy()})
+        return torch.from_numpy(outputs[0]).to(self.device)
+
+    def encode_image(self, images: torch.Tensor) -> torch.Tensor:
+        return self._run(self.image_session, images.to(self.dtype))
+
+    def encode_text(self, text: torch.Tensor) -> torch.Tensor:
+        return self._run(self.text_session, text)
+
+class ImageOnlyBackend:
+    """Wraps a backend whose text encoder has been released; text encoding fails with a clear error."""
+    def __init__(self, backend) -> None:
+        self.name = backend.name
+        self.clip_model = backend.clip_model
+        self.backend = backend
+        for name in ['text_encoder', 'text_session']:
+            if hasattr(backend, name):
+                setattr(backend, name, None)
+
+    def encode_image(self, images: torch.Tensor) -> torch.Tensor:
+        return self.backend.encode_image(images)
+
+    def encode_text(self, text: torch.Tensor) -> torch.Tensor:
+        raise TextEncoderReleased('The CLIP text encoder was released by --image_only')
+
+def max_feature_error(reference, backend, images: torch.Tensor, text: torch.Tensor) -> float:
+    """Largest absolute difference between the normalized features of two backends."""
+    error = 0.0
+    with torch.no_grad():
+        for encode in ['encode_image', 'encode_text']:
+            value = images if encode == 'encode_image' else text
+            if value is None:
+                continue
+            a = getattr(reference, encode)(value).float()
+            b = getattr(backend, encode)(value).float()
+            a = a / a.norm(dim=-1, keepdim=True)
+            b = b / b.norm(dim=-1, keepdim=True)
+            error = max(error, (a - b).abs().max().item())
+    return error
+
+def load_backend(name: str, clip_model, image_example, text_example, artifact_prefix: str, tolerance: float = 1e-2):
+    """Build the requested backend, falling back to eager if it cannot be built or disagrees with it."""
+    eager = EagerBackend(clip_model)
+    if name == 'eager':
+        return eager
+    start_time = time.time()
+    try:
+        if name == 'torchscript':
+            backend = TorchScriptBackend(clip_model, image_example, text_example, artifact_prefix)
+        elif name == 'compile':
+            backend = CompileBackend(clip_model, text=text_example is not None)
+        elif name == 'onnx':
+            backend = OnnxBackend(clip_model, image_example, text_example, artifact_prefix)
+        else:
+            raise ValueError(f'Unknown backend {name}, expected one of {", ".join(BACKENDS)}')
+        error = max_feature_error(eager, backend, image_example, text_example)
+    except (RuntimeError, ValueError, OSError) as e:
+        logging.error(f'Could not load {name} backend, using eager PyTorch: {e}')
+        return eager
+    if error > tolerance:
+        logging.error(f'{name} backend differs from eager PyTorch by {error:.4f}, using eager PyTorch. '
+                      f'Delete {artifact_prefix}_* to re-export it.')
+        return eager
+    logging.info(f'Loaded {name} backend in {time.time()-start_time:.2f} seconds (max feature error {error:.2e}).')
+    return backend
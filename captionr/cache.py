@@ -0,0 +1,136 @@
+import asyncio
+import hashlib
+import time
+from collections import OrderedDict
+from urllib.parse import urlsplit, urlunsplit
+
+# Every option that changes the caption produced for a given image
+CAPTION_OPTIONS = [
+    'clip_model_name', 'clip_method', 'clip_max_flavors', 'clip_beam_width', 'clip_beam_candidates',
+    'clip_flavor', 'clip_artist', 'clip_medium', 'clip_movement', 'clip_trending',
+    'ignore_tags', 'cap_length', 'uniquify_tags', 'fuzz_ratio',
+    'find', 'replace', 'prepend_text', 'append_text', 'fast_decode', 'precision',
+]
+
+def options_key(config) -> str:
+    values = [f'{name}={getattr(config, name, None)!r}' for name in CAPTION_OPTIONS]
+    return hashlib.sha256('\n'.join(values).encode()).hexdigest()[:16]
+
+def content_key(contents: bytes, config) -> str:
+    return f'sha256:{hashlib.sha256(contents).hexdigest()}:{options_key(config)}'
+
+def normalize_url(url: str) -> str:
+    parts = urlsplit(url.strip())
+    netloc = parts.netloc.lower()
+    if parts.scheme == 'http' and netloc.endswith(':80'):
+        netloc = netloc[:-3]
+    elif parts.scheme == 'https' and netloc.endswith(':443'):
+        netloc = netloc[:-4]
+    return urlunsplit((parts.scheme.lower(), netloc, parts.path or '/', parts.query, ''))
+
+def url_key(url: str, etag: str, config) -> str:
+    return f'url:{normalize_url(url)}:{etag}:{options_key(config)}'
+
+class ResponseCache:
+    """LRU + TTL cache of finished captions with single-flight deduplication.
+
+    Bounded both by entry count and by the approximate bytes held. Concurrent requests for a key
+    that is still being computed wait on the first request's result instead of running the model
+    again. Meant to be used from the event loop thread only.
+    """
+    ENTRY_OVERHEAD = 200  # rough per-entry bookkeeping cost in bytes
+
+    def __init__(self, max_entries: int = 1024, ttl: float = 3600, max_bytes: int = 64 * 1024 * 1024) -> None:
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # key -> (expires_at, value, size)
+        self.inflight = {}
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def _size(self, key: str, value: str) -> int:
+        return len(key) + len(value.encode('utf-8')) + self.ENTRY_OVERHEAD
+
+    def _drop(self, key: str) -> None:
+        _, _, size = self.entries.pop(key)
+        self.bytes -= size
+
+    def get(self, key: str):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] < time.monotonic():
+            self._drop(key)
+            self.expirations += 1
+            return None
+        self.entries.move_to_end(key)
+        return entry[1]
+
+    def put(self, key: str, value: str) -> None:
+        size = self._size(key, value)
+        if size > self.max_bytes or self.max_entries <= 0:
+            return
+        if key in self.entries:
+            self._drop(key)
+        self.entries[key] = (time.monotonic() + self.ttl, value, size)
+        self.bytes += size
+        while len(self.entries) > self.max_entries or self.bytes > self.max_bytes:
+            self._drop(next(iter(self.entries)))
+            self.evictions += 1
+
+    async def get_or_compute(self, key: str, compute):
+        """Return the cached value for key, or await compute() once for all concurrent callers."""
+        value = self.get(key)
+        if value is not None:
+            self.hits += 1
+            return value
+        pending = self.inflight.get(key)
+        if pending is not None:
+            self.coalesced += 1
+            try:
+                return await asyncio.shield(pending)
+            except asyncio.CancelledError:
+                if not pending.cancelled():
+                    raise
+                # The request computing it went away; compute it for this caller instead
+                return await self.get_or_compute(key, compute)
+
+        self.misses += 1
+        pending = asyncio.get_running_loop().create_future()
+        self.inflight[key] = pending
+        try:
+            value = await compute()
+        except asyncio.CancelledError:
+            pending.cancel()
+            raise
+        except Exception as e:
+            pending.set_exception(e)
+            pending.exception()  # followers re-raise it; don't warn when there are none
+            raise
+        finally:
+            del self.inflight[key]
+        self.put(key, value)
+        pending.set_result(value)
+        return value
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses + self.coalesced
+        return {
+            "entries": len(self.entries),
+            "bytes": self.bytes,
+            "max_entries": self.max_entries,
+            "max_bytes": self.max_bytes,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "inflight": len(self.inflight),
+            "hit_rate": (self.hits + self.coalesced) / lookups if lookups else 0.0,
+        }
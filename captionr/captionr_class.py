@@ -1,9 +1,10 @@
+import copy
 import pathlib
 import logging
 from dataclasses import dataclass
-from PIL import Image
 import os
-from captionr.clip_interrogator import Interrogator, Config
+from captionr.clip_interrogator import Interrogator, Config, _truncate_to_fit
+from captionr.decode import open_image
 import torch
 import re
 from thefuzz import fuzz
@@ -22,6 +23,8 @@ class CaptionrConfig:
     clip_movement = False
     clip_trending = False
     clip_method = 'interrogate_fast'
+    clip_beam_width = 4
+    clip_beam_candidates = 64
     ignore_tags = ''
     find = ''
     replace = ''
@@ -39,11 +42,42 @@ class CaptionrConfig:
     debug = False
     base_path = os.path.dirname(__file__)
     fuzz_ratio = 60.0
+    fast_decode = False
+    precision = None
+    image_only = False
+    dedup = False
+    dedup_threshold = 4
     _clip: Interrogator = None
 
+def _parse_bool(value) -> bool:
+    if isinstance(value, str):
+        return value.strip().lower() in ['1', 'true', 'yes', 'on']
+    return bool(value)
+
+# Options a single API request may override; everything else stays as configured at startup
+REQUEST_OPTIONS = {
+    'clip_method': str,
+    'clip_max_flavors': int,
+    'clip_flavor': _parse_bool,
+    'clip_artist': _parse_bool,
+    'clip_medium': _parse_bool,
+    'clip_movement': _parse_bool,
+    'clip_trending': _parse_bool,
+    'ignore_tags': str,
+    'cap_length': int,
+    'uniquify_tags': _parse_bool,
+}
+CLIP_METHODS = ['interrogate', 'interrogate_fast', 'interrogate_classic', 'interrogate_beam']
+# Methods that re-encode prompts, and so need the text encoder that --image_only releases
+TEXT_CLIP_METHODS = ['interrogate', 'interrogate_beam']
+
 class Captionr:
     def __init__(self, config: CaptionrConfig) -> None:
         self.config = config
+        # CLIP output of near-duplicate representatives, keyed by path: interrogate_classic's
+        # picks, otherwise the text after their own caption
+        self.shared_tags = {}
+        self.reused = 0
 
     def get_parent_folder(self, filepath, levels=1):
         common = os.path.split(filepath)[0]
@@ -58,8 +92,55 @@ class Captionr:
                 break
         return paths
 
-    def process_img_api(self, img):
-        config = self.config
+    def decode_size(self):
+        # Decode near the CLIP input size only when fast decoding is on and a model will consume the image
+        if self.config.fast_decode and self.config._clip is not None:
+            return self.config._clip.input_size
+        return None
+
+    def request_options(self, **overrides):
+        """Return a copy of the startup config with the given per-request options applied.
+
+        Options left as None keep their configured value. The copy shares the loaded model,
+        so any number of option profiles can be served from one resident Interrogator.
+        """
+        options = copy.copy(self.config)
+        for name, value in overrides.items():
+            if name not in REQUEST_OPTIONS:
+                raise ValueError(f'Unknown caption option: {name}')
+            if value is not None:
+                setattr(options, name, REQUEST_OPTIONS[name](value))
+        if options.clip_method not in CLIP_METHODS:
+            raise ValueError(f'clip_method must be one of {", ".join(CLIP_METHODS)}')
+        if options.image_only and options.clip_method in TEXT_CLIP_METHODS:
+            raise ValueError(f'clip_method {options.clip_method} is unavailable: this server runs with --image_only')
+        if options.clip_max_flavors < 1:
+            raise ValueError('clip_max_flavors must be at least 1')
+        if options.cap_length < 0:
+            raise ValueError('cap_length cannot be negative')
+        return options
+
+    def process_imgs_api(self, imgs, options=None):
+        """Caption several images with one batched encode.
+
+        Returns one entry per image: its caption, or the exception raised while captioning it,
+        so one bad image does not fail the rest of the batch.
+        """
+        config = options if options is not None else self.config
+        # Encode every image in a single forward pass, then finish each caption from its own row
+        image_features = None
+        if (config.clip_artist or config.clip_flavor or config.clip_trending or config.clip_movement or config.clip_medium) and config._clip is not None:
+            image_features = config._clip.images_to_features(imgs)
+        results = []
+        for i, img in enumerate(imgs):
+            try:
+                results.append(self.process_img_api(img, image_features=None if image_features is None else image_features[i:i+1], options=config))
+            except Exception as e:
+                results.append(e)
+        return results
+
+    def process_img_api(self, img, image_features=None, options=None):
+        config = options if options is not None else self.config
         try:
             # Since we're processing an image directly, no file operations are needed
             existing_caption = ''
@@ -68,7 +149,7 @@ class Captionr:
             # Use clip_interrogator to process image and existing caption
             if (config.clip_artist or config.clip_flavor or config.clip_trending or config.clip_movement or config.clip_medium) and config._clip is not None:
                 func = getattr(config._clip, config.clip_method)
-                tags = func(caption=new_caption, image=img, max_flavors=config.clip_max_flavors)
+                tags = func(caption=new_caption, image=img, max_flavors=config.clip_max_flavors, image_features=image_features, captionr_config=config)
                 logging.debug(f'CLIP tags: {tags}')
                 out_tags = [tag.strip() for tag in tags.split(",")]
             else:
@@ -88,7 +169,7 @@ class Captionr:
                     if not tstr in unique_tags and not "_\(" in tag and tstr not in tags_to_ignore:
                         should_append = True
                         for s in unique_tags:
-                            if fuzz.ratio(s, tstr) > self.config.fuzz_ratio:
+                            if fuzz.ratio(s, tstr) > config.fuzz_ratio:
                                 should_append = False
                                 break
                         if should_append:
@@ -122,11 +203,11 @@ class Captionr:
             logging.exception(f"Exception occurred processing image")
             raise e
 
-    def process_img(self, img_path):
+    def process_img(self, img_path, reuse_from=None):
         config = self.config
         try:
             # Load image
-            with Image.open(img_path).convert('RGB') as img:
+            with open_image(img_path, self.decode_size()) as img:
                 # Get existing caption
                 existing_caption = ''
                 cap_file = os.path.join(os.path.dirname(img_path), os.path.splitext(os.path.basename(img_path))[0] + f'.{config.extension}')
@@ -137,101 +218,7 @@ class Captionr:
                     except Exception as e:
                         logging.exception(f"Got exception reading caption file: {e}")
 
-                # Get caption from filename if empty
-                if existing_caption == '' and config.use_filename:
-                    path = os.path.basename(img_path)
-                    path = os.path.splitext(path)[0]
-                    existing_caption = ''.join(c for c in path if c.isalpha() or c in [" ", ","])
-
-                # Initialize out_tags with existing caption
-                out_tags = []
-                new_caption = existing_caption
-
-                # Use clip_interrogator to process image and existing caption
-                if (config.clip_artist or config.clip_flavor or config.clip_trending or config.clip_movement or config.clip_medium) and config._clip is not None:
-                    func = getattr(config._clip, config.clip_method)
-                    tags = func(caption=new_caption, image=img, max_flavors=config.clip_max_flavors)
-                    logging.debug(f'CLIP tags: {tags}')
-                    for tag in tags.split(","):
-                        out_tags.append(tag.strip())
-                else:
-                    for tag in new_caption.split(","):
-                        out_tags.append(tag.strip())
-
-                # Add parent folder to tag list if enabled
-                if config.folder_tag:
-                    folder_tags = self.get_parent_folder(img_path, config.folder_tag_levels)
-                    for tag in folder_tags:
-                        out_tags.append(tag.strip())
-
-                # Remove duplicates, filter similar tags
-                unique_tags = []
-                tags_to_ignore = []
-                if config.ignore_tags != "" and config.ignore_tags is not None:
-                    si_tags = config.ignore_tags.split(",")
-                    for tag in si_tags:
-                        tags_to_ignore.append(tag.strip())
-
-                if config.uniquify_tags:
-                    for tag in out_tags:
-                        tstr = tag.strip()
-                        if not tstr in unique_tags and not "_\(" in tag and tstr not in tags_to_ignore:
-                            should_append = True
-                            for s in unique_tags:
-                                if fuzz.ratio(s, tstr) > self.config.fuzz_ratio:
-                                    should_append = False
-                                    break
-                            if should_append:
-                                unique_tags.append(tag.replace('"', '').strip())
-                else:
-                    for tag in out_tags:
-                        if not "_\(" in tag and tag.strip() not in tags_to_ignore:
-                            unique_tags.append(tag.replace('"', '').strip())
-
-                existing_tags = existing_caption.split(",")
-                logging.debug(f'Unique tags: {unique_tags}')
-                logging.debug(f'Existing Tags: {existing_tags}')
-
-                # Handle existing captions based on the specified option
-                if config.existing == "prepend" and len(existing_tags):
-                    new_tags = existing_tags
-                    for tag in unique_tags:
-                        if not tag.strip() in new_tags or not config.uniquify_tags:
-                            new_tags.append(tag.strip())
-                    unique_tags = new_tags
-
-                if config.existing == 'append' and len(existing_tags):
-                    for tag in existing_tags:
-                        if not tag.strip() in unique_tags or not config.uniquify_tags:
-                            unique_tags.append(tag.strip())
-
-                if config.existing == 'copy' and existing_caption:
-                    for tag in existing_tags:
-                        unique_tags.append(tag.strip())
-
-                try:
-                    unique_tags.remove('')
-                except ValueError:
-                    pass
-
-                # Construct new caption from tag list
-                caption_txt = ", ".join(unique_tags)
-
-                if config.find is not None and config.find != '' and config.replace is not None and config.replace != '':
-                    if f"{config.find}" in caption_txt:
-                        caption_txt = caption_txt.replace(f"{config.find}", config.replace)
-
-                tags = caption_txt.split(" ")
-                if config.cap_length != 0 and len(tags) > config.cap_length:
-                    tags = tags[0:config.cap_length]
-                    tags[-1] = tags[-1].rstrip(",")
-                caption_txt = " ".join(tags)
-
-                if config.append_text != '' and config.append_text is not None:
-                    caption_txt = caption_txt + config.append_text
-
-                if config.prepend_text != '' and config.prepend_text is not None:
-                    caption_txt = config.prepend_text.rstrip().lstrip() + ' ' + caption_txt
+                caption_txt = self.caption_image(img, img_path, existing_caption, reuse_from=reuse_from)
 
                 # Write caption file
                 if not config.preview:
@@ -253,3 +240,139 @@ class Captionr:
                 return caption_txt
         except Exception as e:
             logging.exception(f"Exception occurred processing {img_path}")
+
+    def process_sample(self, sample, img, writer):
+        config = self.config
+        try:
+            # Folder tags and filename captions see the member as if the shard were a folder
+            img_path = os.path.join(os.path.splitext(sample.archive)[0], sample.name)
+            caption_txt = self.caption_image(img, img_path, sample.existing_caption)
+
+            if config.preview:
+                logging.info(f'PREVIEW: {caption_txt}')
+                logging.info('No caption file written.')
+            else:
+                destination = writer.write(sample, caption_txt)
+                logging.info(f'{destination}: {caption_txt}')
+
+            return caption_txt
+        except Exception as e:
+            logging.exception(f"Exception occurred processing {sample.archive}:{sample.name}")
+
+    def caption_image(self, img, img_path, existing_caption='', reuse_from=None):
+        config = self.config
+
+        # Get caption from filename if empty
+        if existing_caption == '' and config.use_filename:
+            path = os.path.basename(img_path)
+            path = os.path.splitext(path)[0]
+            existing_caption = ''.join(c for c in path if c.isalpha() or c in [" ", ","])
+
+        # Initialize out_tags with existing caption
+        out_tags = []
+        new_caption = existing_caption
+
+        # Use clip_interrogator to process image and existing caption
+        if (config.clip_artist or config.clip_flavor or config.clip_trending or config.clip_movement or config.clip_medium) and config._clip is not None:
+            # A near-duplicate reuses its representative's CLIP output around its own caption:
+            # interrogate_classic's per-category picks, or for the other methods the text that
+            # followed the representative's caption, truncated again for the new caption's length
+            if reuse_from is not None and reuse_from in self.shared_tags:
+                if config.clip_method == 'interrogate_classic':
+                    tags = config._clip.classic_prompt(new_caption, self.shared_tags[reuse_from])
+                else:
+                    tags = _truncate_to_fit(new_caption + self.shared_tags[reuse_from], config._clip.tokenize)
+                self.reused += 1
+            elif config.clip_method == 'interrogate_classic':
+                picks = config._clip.classic_picks(img, max_flavors=config.clip_max_flavors)
+                tags = config._clip.classic_prompt(new_caption, picks)
+                if config.dedup:
+                    self.shared_tags[img_path] = picks
+            else:
+                func = getattr(config._clip, config.clip_method)
+                tags = func(caption=new_caption, image=img, max_flavors=config.clip_max_flavors)
+                if config.dedup and tags.startswith(new_caption):
+                    self.shared_tags[img_path] = tags[len(new_caption):]
+            logging.debug(f'CLIP tags: {tags}')
+            for tag in tags.split(","):
+                out_tags.append(tag.strip())
+        else:
+            for tag in new_caption.split(","):
+                out_tags.append(tag.strip())
+
+        # Add parent folder to tag list if enabled
+        if config.folder_tag:
+            folder_tags = self.get_parent_folder(img_path, config.folder_tag_levels)
+            for tag in folder_tags:
+                out_tags.append(tag.strip())
+
+        # Remove duplicates, filter similar tags
+        unique_tags = []
+        tags_to_ignore = []
+        if config.ignore_tags != "" and config.ignore_tags is not None:
+            si_tags = config.ignore_tags.split(",")
+            for tag in si_tags:
+                tags_to_ignore.append(tag.strip())
+
+        if config.uniquify_tags:
+            for tag in out_tags:
+                tstr = tag.strip()
+                if not tstr in unique_tags and not "_\(" in tag and tstr not in tags_to_ignore:
+                    should_append = True
+                    for s in unique_tags:
+                        if fuzz.ratio(s, tstr) > self.config.fuzz_ratio:
+                            should_append = False
+                            break
+                    if should_append:
+                        unique_tags.append(tag.replace('"', '').strip())
+        else:
+            for tag in out_tags:
+                if not "_\(" in tag and tag.strip() not in tags_to_ignore:
+                    unique_tags.append(tag.replace('"', '').strip())
+
+        existing_tags = existing_caption.split(",")
+        logging.debug(f'Unique tags: {unique_tags}')
+        logging.debug(f'Existing Tags: {existing_tags}')
+
+        # Handle existing captions based on the specified option
+        if config.existing == "prepend" and len(existing_tags):
+            new_tags = existing_tags
+            for tag in unique_tags:
+                if not tag.strip() in new_tags or not config.uniquify_tags:
+                    new_tags.append(tag.strip())
+            unique_tags = new_tags
+
+        if config.existing == 'append' and len(existing_tags):
+            for tag in existing_tags:
+                if not tag.strip() in unique_tags or not config.uniquify_tags:
+                    unique_tags.append(tag.strip())
+
+        if config.existing == 'copy' and existing_caption:
+            for tag in existing_tags:
+                unique_tags.append(tag.strip())
+
+        try:
+            unique_tags.remove('')
+        except ValueError:
+            pass
+
+        # Construct new caption from tag list
+        caption_txt = ", ".join(unique_tags)
+
+        if config.find is not None and config.find != '' and config.replace is not None and config.replace != '':
+            if f"{config.find}" in caption_txt:
+                caption_txt = caption_txt.replace(f"{config.find}", config.replace)
+
+        tags = caption_txt.split(" ")
+        if config.cap_length != 0 and len(tags) > config.cap_length:
+            tags = tags[0:config.cap_length]
+            tags[-1] = tags[-1].rstrip(",")
+        caption_txt = " ".join(tags)
+
+        if config.append_text != '' and config.append_text is not None:
+            caption_txt = caption_txt + config.append_text
+
+        if config.prepend_text != '' and config.prepend_text is not None:
+            caption_txt = config.prepend_text.rstrip().lstrip() + ' ' + caption_txt
+
+        return caption_txt
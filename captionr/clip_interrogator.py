@@ -1,4 +1,5 @@
 import hashlib
+import itertools
 import math
 import numpy as np
 import open_clip
@@ -13,6 +14,8 @@ from typing import List
 import logging
 import requests
 from thefuzz import fuzz
+from captionr.backends import EagerBackend, ImageOnlyBackend, TextEncoderReleased, load_backend
+from captionr.decode import FastPreprocess
 
 @dataclass 
 class Config:
@@ -31,7 +34,12 @@ class Config:
     data_path: str = os.path.join(os.path.dirname(__file__), 'data')
     device: str = ("mps" if torch.backends.mps.is_available() else "cuda" if torch.cuda.is_available() else "cpu")
     flavor_intermediate_count: int = 2048
+    beam_expand: int = 16 # unused flavors each beam is extended with per interrogate_beam step
     quiet: bool = False # when quiet progress bars are not shown
+    fast_decode: bool = False # batch preprocess into a reusable tensor buffer instead of clip_preprocess
+    backend: str = 'eager' # eager, torchscript, compile or onnx; exported graphs are cached in cache_path
+    image_only: bool = False # free the text tower once the label tables exist; only interrogate_fast/classic work then
+    precision: str = None # fp32, fp16 or int8 (dynamic quantization, CPU only); None picks fp16 on cuda, fp32 elsewhere
 
     fuzz_ratio: int = 50
 
@@ -46,6 +54,9 @@ class Interrogator():
         start_time = time.time()
         config = self.config
         logging.info(f'Config cache path: {config.cache_path}')
+        self.precision = config.precision or ('fp16' if config.device == 'cuda' else 'fp32')
+        if self.precision == 'int8' and config.device != 'cpu':
+            raise ValueError('int8 precision uses dynamic quantization, which only runs on --device cpu')
         if config.clip_model is None:
             if config.clip_model_name == 'ViT-L-14/openai':
                 if not os.path.exists(os.path.join(config.cache_path,'ViT-L-14_openai_flavors.pkl')):
@@ -133,16 +144,28 @@ class Interrogator():
             self.clip_model, _, self.clip_preprocess = open_clip.create_model_and_transforms(
                 clip_model_name, 
                 pretrained=clip_model_pretrained_name, 
-                precision='fp16' if config.device == 'cuda' else 'fp32',
+                precision='fp32' if self.precision == 'int8' else self.precision,
                 device=config.device,
                 jit=False,
                 cache_dir=config.clip_model_path
             )
             self.clip_model.to(config.device).eval()
+            if self.precision == 'int8':
+                fp32_bytes = self.model_bytes
+                self.clip_model = _quantize_dynamic(self.clip_model)
+                logging.info(f'int8 dynamic quantization: model {fp32_bytes/2**20:.0f} MB -> {self.model_bytes/2**20:.0f} MB '
+                             f'({100*(1-self.model_bytes/fp32_bytes):.0f}% smaller)')
         else:
             self.clip_model = config.clip_model
             self.clip_preprocess = config.clip_preprocess
         self.tokenize = open_clip.get_tokenizer(clip_model_name)
+        self.fast_preprocess = FastPreprocess(self.clip_preprocess)
+        self.input_size = self.fast_preprocess.size
+        if self.precision == 'int8':
+            # Run both quantized encoders once so a broken model fails here, not in the first table or request
+            with torch.no_grad():
+                self.clip_model.encode_image(torch.zeros(1, 3, self.input_size, self.input_size, device=self.device))
+                self.clip_model.encode_text(self.tokenize(['a photo of a cat']).to(self.device))
 
         sites = ['Artstation', 'behance', 'cg society', 'cgsociety', 'deviantart', 'dribble', 'flickr', 'instagram', 'pexels', 'pinterest', 'pixabay', 'pixiv', 'polycount', 'reddit', 'shutterstock', 'tumblr', 'unsplash', 'zbrush central']
         trending_list = [site for site in sites]
@@ -154,23 +177,79 @@ class Interrogator():
         artists = [f"by {a}" for a in raw_artists]
         artists.extend([f"inspired by {a}" for a in raw_artists])
 
-        self.artists = LabelTable(artists, "artists", self.clip_model, self.tokenize, config)
-        self.flavors = LabelTable(_load_list(config.data_path, 'flavors.txt'), "flavors", self.clip_model, self.tokenize, config)
-        self.mediums = LabelTable(_load_list(config.data_path, 'mediums.txt'), "mediums", self.clip_model, self.tokenize, config)
-        self.movements = LabelTable(_load_list(config.data_path, 'movements.txt'), "movements", self.clip_model, self.tokenize, config)
-        self.trendings = LabelTable(trending_list, "trendings", self.clip_model, self.tokenize, config)
+        def load_tables(text_encoder):
+            self.artists = LabelTable(artists, "artists", text_encoder, self.tokenize, config)
+            self.flavors = LabelTable(_load_list(config.data_path, 'flavors.txt'), "flavors", text_encoder, self.tokenize, config)
+            self.mediums = LabelTable(_load_list(config.data_path, 'mediums.txt'), "mediums", text_encoder, self.tokenize, config)
+            self.movements = LabelTable(_load_list(config.data_path, 'movements.txt'), "movements", text_encoder, self.tokenize, config)
+            self.trendings = LabelTable(trending_list, "trendings", text_encoder, self.tokenize, config)
+
+        # In image-only mode the tables are built (normally just read from cache) before anything else,
+        # then the text tower is dropped so no backend ever exports or traces it.
+        self.text_released = False
+        if config.image_only:
+            load_tables(EagerBackend(self.clip_model))
+            self._release_text_tower()
+
+        # Exported encoders are cached next to the label tables, one per model, backend and precision
+        dtype = torch.float16 if self.precision == 'fp16' else torch.float32
+        os.makedirs(config.cache_path or '.', exist_ok=True)
+        sanitized_name = config.clip_model_name.replace('/', '_').replace('@', '_')
+        self.backend = load_backend(
+            config.backend,
+            self.clip_model,
+            torch.randn(2, 3, self.input_size, self.input_size, dtype=dtype, device=self.device),
+            None if self.text_released else self.tokenize(['a photo of a cat', 'an oil painting of a lighthouse']).to(self.device),
+            os.path.join(config.cache_path or '.', f"{sanitized_name}_{config.backend}_{self.precision}")
+        )
+        if self.text_released:
+            self.backend = ImageOnlyBackend(self.backend)
+        else:
+            load_tables(self.backend)
 
         end_time = time.time()
         if not config.quiet:
             logging.info(f"Loaded CLIP model and data in {end_time-start_time:.2f} seconds.")
 
+    def _release_text_tower(self):
+        # CLIP keeps its text tower in these attributes, CustomTextCLIP in .text
+        model = self.clip_model
+        released = self.model_bytes
+        for name in ['transformer', 'token_embedding', 'positional_embedding', 'ln_final', 'text_projection', 'attn_mask', 'text']:
+            if name in model._modules or name in model._parameters or name in model._buffers:
+                delattr(model, name)
+        self.text_released = True
+        if self.device == 'cuda':
+            torch.cuda.empty_cache()
+        logging.info(f'Released CLIP text tower: model {released/2**20:.0f} MB -> {self.model_bytes/2**20:.0f} MB')
+
+    @property
+    def model_bytes(self) -> int:
+        return _model_bytes(self.clip_model)
+
+    def _require_text(self, method: str):
+        if self.text_released:
+            raise TextEncoderReleased(f'{method} needs the CLIP text encoder, which was released by --image_only. '
+                                      f'Use interrogate_fast or interrogate_classic, or restart without --image_only.')
+
     def image_to_features(self, image: Image) -> torch.Tensor:
-        images = self.clip_preprocess(image).unsqueeze(0).to(self.device)
+        return self.images_to_features([image])
+
+    def images_to_features(self, images: List[Image.Image]) -> torch.Tensor:
+        # encode a whole batch in one forward pass; row i belongs to images[i]
+        if self.config.fast_decode:
+            batch = self.fast_preprocess(images).to(self.device)
+        else:
+            batch = torch.stack([self.clip_preprocess(image) for image in images]).to(self.device)
         with torch.no_grad(), torch.cuda.amp.autocast():
-            image_features = self.clip_model.encode_image(images)
+            image_features = self.backend.encode_image(batch)
             image_features /= image_features.norm(dim=-1, keepdim=True)
         return image_features
     
+    def _options(self, captionr_config):
+        # Per-call caption options; the tables and model stay shared between all of them
+        return captionr_config if captionr_config is not None else self.config.captionr_config
+
     def filter_similar_inner(self,existing,token):
         if token == '':
             return False
@@ -189,33 +268,43 @@ class Interrogator():
 
         return new_list
 
-    def interrogate_classic(self, caption: str, image: Image, max_flavors: int=3) -> str:
-        image_features = self.image_to_features(image)
+    def interrogate_classic(self, caption: str, image: Image, max_flavors: int=3, image_features: torch.Tensor = None, captionr_config=None) -> str:
+        return self.classic_prompt(caption, self.classic_picks(image, max_flavors, image_features, captionr_config))
+
+    def classic_picks(self, image: Image, max_flavors: int=3, image_features: torch.Tensor = None, captionr_config=None):
+        """The (medium, artist, trending, movement, flavors) that interrogate_classic formats around a caption."""
+        options = self._options(captionr_config)
+        if image_features is None:
+            image_features = self.image_to_features(image)
 
-        if self.config.captionr_config.clip_medium:
+        if options.clip_medium:
             medium = self.mediums.rank(image_features, 1)[0]
         else:
             medium = ''
-        if self.config.captionr_config.clip_artist:
+        if options.clip_artist:
             artist = self.artists.rank(image_features, 1)[0]
         else:
             artist = ''
         
-        if self.config.captionr_config.clip_trending:
+        if options.clip_trending:
             trending = self.trendings.rank(image_features, 1)[0]
         else:
             trending = ''
 
-        if self.config.captionr_config.clip_movement:
+        if options.clip_movement:
             movement = self.movements.rank(image_features, 1)[0]
         else:
             movement = ''
 
-        if self.config.captionr_config.clip_flavor:
+        if options.clip_flavor:
             flaves = ", ".join(self.filter_similar(self.flavors.rank(image_features, max_flavors*2))[:max_flavors])
         else:
             flaves = ''
 
+        return medium, artist, trending, movement, flaves
+
+    def classic_prompt(self, caption: str, picks) -> str:
+        medium, artist, trending, movement, flaves = picks
         if caption.startswith(medium) and medium != '':
             prompt = f"{caption} {artist}, {trending}, {movement}, {flaves}"
         else:
@@ -223,18 +312,20 @@ class Interrogator():
 
         return _truncate_to_fit(prompt, self.tokenize)
 
-    def interrogate_fast(self, caption: str, image: Image, max_flavors: int = 32) -> str:
-        image_features = self.image_to_features(image)
+    def interrogate_fast(self, caption: str, image: Image, max_flavors: int = 32, image_features: torch.Tensor = None, captionr_config=None) -> str:
+        options = self._options(captionr_config)
+        if image_features is None:
+            image_features = self.image_to_features(image)
         tables = []
-        if self.config.captionr_config.clip_artist:
+        if options.clip_artist:
             tables.append(self.artists)
-        if self.config.captionr_config.clip_flavor:
+        if options.clip_flavor:
             tables.append(self.flavors)
-        if self.config.captionr_config.clip_medium:
+        if options.clip_medium:
             tables.append(self.mediums)
-        if self.config.captionr_config.clip_movement:
+        if options.clip_movement:
             tables.append(self.movements)
-        if self.config.captionr_config.clip_trending:
+        if options.clip_trending:
             tables.append(self.trendings)
 
         merged = _merge_tables(tables, self.config)
@@ -243,28 +334,31 @@ class Interrogator():
 
         return _truncate_to_fit(caption + ", " + ", ".join(tops), self.tokenize)
 
-    def interrogate(self, caption: str, image: Image, max_flavors: int=32) -> str:
-        image_features = self.image_to_features(image)
+    def interrogate(self, caption: str, image: Image, max_flavors: int=32, image_features: torch.Tensor = None, captionr_config=None) -> str:
+        self._require_text('interrogate')
+        options = self._options(captionr_config)
+        if image_features is None:
+            image_features = self.image_to_features(image)
 
-        if self.config.captionr_config.clip_flavor:
+        if options.clip_flavor:
             flaves = self.flavors.rank(image_features, self.config.flavor_intermediate_count*2)
             flaves = self.filter_similar(flaves)[:self.config.flavor_intermediate_count]
         else:
             flaves = ''
-        if self.config.captionr_config.clip_medium:
+        if options.clip_medium:
             best_medium = self.mediums.rank(image_features, 1)[0]
         else:
             best_medium = ''
-        if self.config.captionr_config.clip_artist:
+        if options.clip_artist:
             best_artist = self.artists.rank(image_features, 1)[0]
         else:
             best_artist = ''
-        if self.config.captionr_config.clip_trending:
+        if options.clip_trending:
             best_trending = self.trendings.rank(image_features, 1)[0]
         else:
             best_trending = ''
         
-        if self.config.captionr_config.clip_movement:
+        if options.clip_movement:
             best_movement = self.movements.rank(image_features, 1)[0]
         else:
             best_movement = ''
@@ -292,7 +386,7 @@ class Interrogator():
                         prompt += ", " + opts[bit]
                 prompts.append(prompt)
 
-            t = LabelTable(prompts, None, self.clip_model, self.tokenize, self.config)
+            t = LabelTable(prompts, None, self.backend, self.tokenize, self.config)
             best_prompt = t.rank(image_features, 1)[0]
             best_sim = self.similarity(image_features, best_prompt)
 
@@ -311,18 +405,102 @@ class Interrogator():
 
         return best_prompt
 
+    def interrogate_beam(self, caption: str, image: Image, max_flavors: int=32, image_features: torch.Tensor = None, captionr_config=None) -> str:
+        """Bounded beam search approximation of interrogate.
+
+        Flavor candidates are pruned with the precomputed label embeddings before any prompt is
+        re-encoded, and every step scores all beam expansions in a single batched encode_text
+        call, so the text encoder runs on at most beam_width * beam_expand prompts per step.
+        """
+        self._require_text('interrogate_beam')
+        options = self._options(captionr_config)
+        if image_features is None:
+            image_features = self.image_to_features(image)
+        beam_width = max(1, getattr(options, 'clip_beam_width', 4))
+        beam_candidates = max(1, getattr(options, 'clip_beam_candidates', 64))
+        beam_expand = max(1, min(beam_candidates, self.config.beam_expand))
+
+        # Same one-per-category choice as interrogate, scored in one batch over all 2^n combinations
+        opts = []
+        if options.clip_medium:
+            opts.append(self.mediums.rank(image_features, 1)[0])
+        if options.clip_artist:
+            opts.append(self.artists.rank(image_features, 1)[0])
+        if options.clip_trending:
+            opts.append(self.trendings.rank(image_features, 1)[0])
+        if options.clip_movement:
+            opts.append(self.movements.rank(image_features, 1)[0])
+        prompts = []
+        for i in range(2**len(opts)):
+            prompt = caption
+            for bit in range(len(opts)):
+                if i & (1 << bit):
+                    prompt += ", " + opts[bit]
+            prompts.append(prompt)
+        sims = self.similarities(image_features, prompts)
+        best_sim, best_prompt = max(zip(sims, prompts))
+
+        if not options.clip_flavor:
+            return best_prompt
+
+        # Candidates stay in label-score order, so each beam expands with its best unused ones first
+        candidates = self.filter_similar(self.flavors.rank(image_features, beam_candidates*2))[:beam_candidates]
+        beams = [(best_sim, best_prompt, frozenset())]
+        encoded = len(prompts)
+        for _ in range(max_flavors):
+            expansions = {}
+            for _, prompt, used in beams:
+                if _prompt_at_max_len(prompt, self.tokenize):
+                    continue
+                added = 0
+                for flavor in candidates:
+                    if added >= beam_expand:
+                        break
+                    if flavor in used:
+                        continue
+                    added += 1
+                    key = used | {flavor}
+                    if key not in expansions:
+                        expansions[key] = f"{prompt}, {flavor}"
+            if not expansions:
+                break
+
+            keys = list(expansions.keys())
+            prompts = [expansions[k] for k in keys]
+            sims = self.similarities(image_features, prompts)
+            encoded += len(prompts)
+            ranked = sorted(zip(sims, prompts, keys), key=lambda b: b[0], reverse=True)
+            beams = ranked[:beam_width]
+            if beams[0][0] <= best_sim:
+                break
+            best_sim, best_prompt = beams[0][0], beams[0][1]
+
+        logging.debug(f'Beam search encoded {encoded} prompts, similarity {best_sim:.4f}')
+        return best_prompt
+
     def rank_top(self, image_features: torch.Tensor, text_array: List[str]) -> str:
         text_tokens = self.tokenize([text for text in text_array]).to(self.device)
         with torch.no_grad(), torch.cuda.amp.autocast():
-            text_features = self.clip_model.encode_text(text_tokens)
+            text_features = self.backend.encode_text(text_tokens)
             text_features /= text_features.norm(dim=-1, keepdim=True)
             similarity = text_features @ image_features.T
         return text_array[similarity.argmax().item()]
 
+    def similarities(self, image_features: torch.Tensor, text_array: List[str]) -> List[float]:
+        sims = []
+        for start in range(0, len(text_array), self.config.chunk_size):
+            text_tokens = self.tokenize(text_array[start:start+self.config.chunk_size]).to(self.device)
+            with torch.no_grad(), torch.cuda.amp.autocast():
+                text_features = self.backend.encode_text(text_tokens)
+                text_features /= text_features.norm(dim=-1, keepdim=True)
+                similarity = text_features @ image_features.T
+            sims.extend(similarity[:, 0].float().cpu().tolist())
+        return sims
+
     def similarity(self, image_features: torch.Tensor, text: str) -> float:
         text_tokens = self.tokenize([text]).to(self.device)
         with torch.no_grad(), torch.cuda.amp.autocast():
-            text_features = self.clip_model.encode_text(text_tokens)
+            text_features = self.backend.encode_text(text_tokens)
             text_features /= text_features.norm(dim=-1, keepdim=True)
             similarity = text_features @ image_features.T
         return similarity[0][0].item()
@@ -339,11 +517,15 @@ class LabelTable():
 
         hash = hashlib.sha256(",".join(labels).encode()).hexdigest()
 
+        # Embeddings are reused per label: a vocabulary edit only encodes the new or changed lines
+        known = {}
         cache_filepath = None
         if config.cache_path is not None and desc is not None:
             os.makedirs(config.cache_path, exist_ok=True)
             sanitized_name = config.clip_model_name.replace('/', '_').replace('@', '_')
-            cache_filepath = os.path.join(config.cache_path, f"{sanitized_name}_{desc}.pkl")
+            # int8 text embeddings differ from fp16/fp32 ones, so they never share a cache file
+            precision = '_int8' if config.precision == 'int8' else ''
+            cache_filepath = os.path.join(config.cache_path, f"{sanitized_name}_{desc}{precision}.pkl")
             if desc is not None and os.path.exists(cache_filepath):
                 with open(cache_filepath, 'rb') as f:
                     try:
@@ -351,12 +533,14 @@ class LabelTable():
                         if data.get('hash') == hash:
                             self.labels = data['labels']
                             self.embeds = data['embeds']
+                        elif data.get('model', config.clip_model_name) == config.clip_model_name:
+                            known = dict(zip(data['labels'], data['embeds']))
                     except Exception as e:
                         logging.error(f"Error loading cached table {desc}: {e}")
 
         if len(self.labels) != len(self.embeds):
-            self.embeds = []
-            chunks = np.array_split(self.labels, max(1, len(self.labels)/config.chunk_size))
+            missing = [label for label in dict.fromkeys(self.labels) if label not in known]
+            chunks = [missing[i:i+config.chunk_size] for i in range(0, len(missing), config.chunk_size)]
             for chunk in tqdm(chunks, desc=f"Preprocessing {desc}" if desc else None, disable=self.config.quiet):
                 text_tokens = self.tokenize(chunk).to(self.device)
                 with torch.no_grad(), torch.cuda.amp.autocast():
@@ -364,7 +548,14 @@ class LabelTable():
                     text_features /= text_features.norm(dim=-1, keepdim=True)
                     text_features = text_features.half().cpu().numpy()
                 for i in range(text_features.shape[0]):
-                    self.embeds.append(text_features[i])
+                    known[chunk[i]] = text_features[i]
+
+            # Rebuild in label order; labels no longer in the vocabulary are dropped from the stored table
+            self.embeds = [known[label] for label in self.labels]
+            if desc is not None:
+                unique = set(self.labels)
+                logging.info(f"Table {desc}: encoded {len(missing)} labels, reused {len(unique) - len(missing)}, "
+                             f"dropped {len(known) - len(unique)} removed ones.")
 
             if cache_filepath is not None:
                 with open(cache_filepath, 'wb') as f:
@@ -406,6 +597,31 @@ class LabelTable():
         return [top_labels[i] for i in tops]
 
 
+def _model_bytes(model) -> int:
+    # Dynamically quantized layers keep their int8 weights in packed params, which parameters() does not report
+    tensors = list(itertools.chain(model.parameters(), model.buffers()))
+    for module in model.modules():
+        packed = getattr(module, '_packed_params', None)
+        if packed is not None and hasattr(packed, '_weight_bias'):
+            tensors.extend(t for t in packed._weight_bias() if t is not None)
+    return sum(t.nelement() * t.element_size() for t in tensors)
+
+def _quantize_dynamic(model):
+    """Quantize the nn.Linear layers of the vision and text transformers (their MLP blocks) to int8.
+
+    Weights are stored as int8 and activations are quantized on the fly per batch, so no
+    calibration data is needed. Attention, embeddings and layer norms stay fp32.
+    """
+    quantization = getattr(torch, 'ao', torch).quantization
+    model = quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    # open_clip casts text inputs to the dtype of the first MLP's .weight, which quantized Linear
+    # layers expose as a method; their activations are fp32, so pin the cast dtype to that
+    for tower in [model, getattr(model, 'text', None), getattr(model, 'visual', None)]:
+        transformer = getattr(tower, 'transformer', None)
+        if transformer is not None and hasattr(transformer, 'get_cast_dtype'):
+            transformer.get_cast_dtype = lambda: torch.float32
+    return model
+
 def _load_list(data_path: str, filename: str) -> List[str]:
     with open(os.path.join(data_path, filename), 'r', encoding='utf-8', errors='replace') as f:
         items = [line.strip() for line in f.readlines()]
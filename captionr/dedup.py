@@ -0,0 +1,93 @@
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+from PIL import Image
+from captionr.decode import open_image
+
+def dhash(img: Image.Image, hash_size: int = 8) -> int:
+    """Difference hash: one bit per horizontally adjacent pixel pair of a tiny grayscale thumbnail.
+
+    Survives resizing and recompression, and small crops or colour changes only flip a few bits.
+    """
+    small = img.convert('L').resize((hash_size + 1, hash_size), Image.BILINEAR)
+    pixels = list(small.getdata())
+    value = 0
+    for row in range(hash_size):
+        for col in range(hash_size):
+            left = pixels[row * (hash_size + 1) + col]
+            right = pixels[row * (hash_size + 1) + col + 1]
+            value = (value << 1) | (left > right)
+    return value
+
+def hash_file(path: str) -> int:
+    # A 64px decode is plenty for a 9x8 thumbnail; JPEGs get there through DCT scaling
+    with open_image(path, 32) as img:
+        return dhash(img)
+
+def hamming(a: int, b: int) -> int:
+    return bin(a ^ b).count('1')
+
+class BKTree:
+    """Burkhard-Keller tree over Hamming distance, so radius queries skip most of the index."""
+    def __init__(self) -> None:
+        self.root = None
+
+    def add(self, value: int, item) -> None:
+        node = (value, item, {})
+        if self.root is None:
+            self.root = node
+            return
+        current = self.root
+        while True:
+            distance = hamming(value, current[0])
+            child = current[2].get(distance)
+            if child is None:
+                current[2][distance] = node
+                return
+            current = child
+
+    def search(self, value: int, radius: int):
+        """Return (distance, item) pairs within radius, closest first."""
+        found = []
+        stack = [self.root] if self.root is not None else []
+        while stack:
+            node = stack.pop()
+            distance = hamming(value, node[0])
+            if distance <= radius:
+                found.append((distance, node[1]))
+            # Triangle inequality: only children keyed within [d - r, d + r] can hold matches
+            for key, child in node[2].items():
+                if distance - radius <= key <= distance + radius:
+                    stack.append(child)
+        return sorted(found, key=lambda f: f[0])
+
+def find_near_duplicates(paths: List[str], threshold: int = 4, workers: int = None) -> Dict[str, str]:
+    """Map each near-duplicate image to the representative whose caption it can reuse.
+
+    Paths are taken in order; an image within `threshold` bits of an earlier representative joins
+    that representative's cluster, otherwise it becomes a representative itself. Representatives
+    therefore always come before their duplicates in `paths`. Images that cannot be hashed are
+    left out of the mapping and captioned normally.
+    """
+    def safe_hash(path):
+        try:
+            return hash_file(path)
+        except Exception as e:
+            logging.warning(f'Could not hash {path} for near-duplicate detection: {e}')
+            return None
+
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+        hashes = list(pool.map(safe_hash, paths))
+
+    index = BKTree()
+    duplicates = {}
+    for path, value in zip(paths, hashes):
+        if value is None:
+            continue
+        matches = index.search(value, threshold)
+        if matches:
+            duplicates[path] = matches[0][1]
+        else:
+            index.add(value, path)
+    return duplicates
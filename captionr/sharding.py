@@ -0,0 +1,189 @@
+import argparse
+import glob
+import hashlib
+import json
+import logging
+import os
+import socket
+import time
+from typing import List
+
+def parse_shard(value: str):
+    """argparse type for --shard i/N (0 <= i < N)."""
+    try:
+        index, count = [int(v) for v in value.split('/')]
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'expected i/N, got {value!r}')
+    if count < 1 or not 0 <= index < count:
+        raise argparse.ArgumentTypeError(f'shard index must satisfy 0 <= i < N, got {value!r}')
+    return index, count
+
+def select_shard(paths: List[str], index: int, count: int) -> List[str]:
+    # Sorting makes the split independent of os.walk order, so every node computes the same partition
+    return sorted(paths)[index::count]
+
+def node_name() -> str:
+    return f'{socket.gethostname()}-{os.getpid()}'
+
+def _write_atomic(path: str, data: dict) -> None:
+    tmp = f'{path}.{node_name()}.tmp'
+    with open(tmp, 'w', encoding='utf8') as f:
+        json.dump(data, f)
+    os.replace(tmp, path)
+
+class ClaimQueue:
+    """Work stealing over a shared filesystem.
+
+    The sorted path list is cut into fixed batches, and every archive is a batch of its own
+    since a shard is read front to back by a single reader. A node owns a batch while it holds
+    claim_dir/batch-NNNNNN.claim, created with O_CREAT|O_EXCL so exactly one node wins it, and
+    refreshes the claim's mtime as it goes. A claim that has not been touched for `timeout`
+    seconds belongs to a slow or dead node: it is renamed away (atomic, so only one thief wins),
+    checked to still be the claim that was judged stale, and claimed again. Finished batches leave a batch-NNNNNN.done JSON record, which is what
+    progress() merges across nodes.
+    """
+    def __init__(self, claim_dir: str, paths: List[str], batch_size: int = 64, timeout: float = 600, poll: float = None, archives: List[str] = ()) -> None:
+        self.claim_dir = claim_dir
+        self.paths = sorted(paths)
+        self.archives = sorted(archives)
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self.poll = poll if poll is not None else min(30.0, timeout / 4)
+        self.node = node_name()
+        self.batches = [self.paths[i:i+batch_size] for i in range(0, len(self.paths), batch_size)]
+        self.batches.extend([archive] for archive in self.archives)
+        os.makedirs(claim_dir, exist_ok=True)
+        self._check_manifest()
+
+    def _check_manifest(self) -> None:
+        # All nodes must agree on the batches, otherwise batch ids would name different images
+        digest = hashlib.sha256('\n'.join(self.paths + self.archives).encode()).hexdigest()
+        manifest = {'digest': digest, 'paths': len(self.paths), 'archives': len(self.archives),
+                    'batch_size': self.batch_size, 'batches': len(self.batches)}
+        path = os.path.join(self.claim_dir, 'manifest.json')
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            with os.fdopen(fd, 'w', encoding='utf8') as f:
+                json.dump(manifest, f)
+            return
+        except FileExistsError:
+            pass
+        for _ in range(10):
+            try:
+                with open(path, encoding='utf8') as f:
+                    existing = json.load(f)
+                break
+            except ValueError:
+                time.sleep(0.5)  # another node is still writing it
+        else:
+            raise RuntimeError(f'{path} is unreadable')
+        if existing['digest'] != digest or existing['batch_size'] != self.batch_size:
+            raise RuntimeError(f'{path} was written for a different image list or batch size. '
+                               f'Run every node with the same folders, archives and --claim_batch, or use a fresh --claim_dir.')
+
+    def _path(self, batch: int, suffix: str) -> str:
+        return os.path.join(self.claim_dir, f'batch-{batch:06d}.{suffix}')
+
+    def _try_claim(self, batch: int) -> bool:
+        claim = self._path(batch, 'claim')
+        try:
+            fd = os.open(claim, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            try:
+                seen = os.stat(claim)
+            except FileNotFoundError:
+                return self._try_claim(batch)
+            if time.time() - seen.st_mtime < self.timeout:
+                return False
+            stale = f'{claim}.stale-{self.node}-{int(time.time())}'
+            try:
+                os.rename(claim, stale)
+            except FileNotFoundError:
+                return False  # another node stole it first
+            # Between the stat and the rename another node may have stolen the claim and claimed the
+            # batch afresh, or the owner refreshed it; only the file judged stale may be taken over.
+            moved = os.stat(stale)
+            age = time.time() - moved.st_mtime
+            if moved.st_ino != seen.st_ino or age < self.timeout:
+                try:
+                    os.link(stale, claim)  # put the live claim back, unless the batch was claimed again meanwhile
+                except FileExistsError:
+                    pass
+                os.remove(stale)
+                return False
+            os.remove(stale)
+            logging.warning(f'Batch {batch} claim went stale after {age:.0f}s, taking it over.')
+            return self._try_claim(batch)
+        with os.fdopen(fd, 'w', encoding='utf8') as f:
+            json.dump({'node': self.node, 'claimed': time.time()}, f)
+        return True
+
+    def heartbeat(self, batch: int) -> None:
+        try:
+            os.utime(self._path(batch, 'claim'))
+        except FileNotFoundError:
+            logging.warning(f'Lost claim on batch {batch}; another node considered it stale.')
+
+    def is_archive(self, batch: int) -> bool:
+        return batch >= len(self.batches) - len(self.archives)
+
+    def complete(self, batch: int, processed: int, failed: int = 0, images: int = None) -> None:
+        # images defaults to the batch size; archive batches pass the number of samples they held
+        _write_atomic(self._path(batch, 'done'), {
+            'node': self.node, 'images': len(self.batches[batch]) if images is None else images,
+            'processed': processed, 'failed': failed, 'finished': time.time(),
+        })
+        self._release(batch)
+
+    def _release(self, batch: int) -> None:
+        # A slow node finishing a batch that was taken over must leave the new owner's claim alone
+        claim = self._path(batch, 'claim')
+        try:
+            with open(claim, encoding='utf8') as f:
+                owner = json.load(f).get('node')
+            if owner == self.node:
+                os.remove(claim)
+        except (FileNotFoundError, ValueError):
+            pass  # already gone, or a new owner is still writing it
+
+    def __iter__(self):
+        """Yield (batch id, paths) for each batch this node claims, until every batch is done."""
+        while True:
+            pending = [b for b in range(len(self.batches)) if not os.path.exists(self._path(b, 'done'))]
+            if not pending:
+                return
+            claimed = False
+            for batch in pending:
+                if self._try_claim(batch):
+                    claimed = True
+                    if os.path.exists(self._path(batch, 'done')):
+                        # finished by another node between the scan and our claim
+                        self._release(batch)
+                        break
+                    yield batch, self.batches[batch]
+                    break
+            if not claimed:
+                # Everything left is held by live nodes; wait in case one of them dies
+                time.sleep(self.poll)
+
+def progress(claim_dir: str) -> dict:
+    """Merge the per-batch records written by every node into one progress summary."""
+    summary = {'batches': None, 'paths': None, 'done': 0, 'in_progress': 0, 'images': 0, 'processed': 0, 'failed': 0, 'nodes': {}}
+    manifest = os.path.join(claim_dir, 'manifest.json')
+    if os.path.exists(manifest):
+        with open(manifest, encoding='utf8') as f:
+            data = json.load(f)
+        summary['batches'], summary['paths'] = data['batches'], data['paths']
+    for path in glob.glob(os.path.join(claim_dir, 'batch-*.done')):
+        with open(path, encoding='utf8') as f:
+            record = json.load(f)
+        node = summary['nodes'].setdefault(record['node'], {'batches': 0, 'processed': 0, 'failed': 0})
+        node['batches'] += 1
+        node['processed'] += record['processed']
+        node['failed'] += record['failed']
+        summary['done'] += 1
+        summary['images'] += record['images']
+        summary['processed'] += record['processed']
+        summary['failed'] += record['failed']
+    summary['in_progress'] = len(glob.glob(os.path.join(claim_dir, 'batch-*.claim')))
+    return summary
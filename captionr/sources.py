@@ -0,0 +1,234 @@
+import io
+import logging
+import os
+import posixpath
+import queue
+import re
+import socket
+import tarfile
+import threading
+import zipfile
+from dataclasses import dataclass
+from typing import Iterator, List
+from PIL import Image
+
+IMAGE_EXTENSIONS = ['.JPEG', '.JPG', '.JPE', '.PNG']
+ARCHIVE_EXTENSIONS = ['.TAR', '.TGZ', '.GZ', '.BZ2', '.XZ', '.ZIP']
+
+@dataclass
+class Sample:
+    archive: str            # path of the shard the sample came from
+    key: str                # relative, unique caption name without extension, e.g. "000123" or "dir/img"
+    name: str               # full member name of the image
+    data: bytes
+    existing_caption: str = ''
+
+def is_archive(path) -> bool:
+    name = str(path).upper()
+    return os.path.isfile(path) and any(name.endswith(ext) for ext in ARCHIVE_EXTENSIONS)
+
+def _split_key(name: str) -> str:
+    # WebDataset groups a sample's files by everything before the first dot of the basename
+    dirname, basename = posixpath.split(name)
+    return posixpath.join(dirname, basename.partition('.')[0])
+
+def _extension(name: str) -> str:
+    # Whether a member is an image or a caption is decided by its last extension only
+    return posixpath.splitext(name)[1].upper()
+
+def safe_key(key: str):
+    """Normalize a member-derived key to a relative path, or return None if it would leave its folder."""
+    key = posixpath.normpath(re.sub(r'^[A-Za-z]:', '', key.replace('\\', '/')).lstrip('/'))
+    if key in ['', '.'] or key == '..' or key.startswith('../'):
+        return None
+    return key
+
+class _KeyAllocator:
+    """Hands out caption keys that are safe to use as paths and unique within one archive."""
+    def __init__(self, archive: str) -> None:
+        self.archive = archive
+        self.used = set()
+
+    def key(self, preferred: str, name: str):
+        # Fall back to the full member name when the preferred key is taken, e.g. 0001.jpg next to 0001.png
+        for candidate in [preferred, name]:
+            candidate = safe_key(candidate)
+            if candidate is None:
+                logging.warning(f'Skipping {self.archive}:{name}: member name points outside the archive.')
+                return None
+            if candidate not in self.used:
+                self.used.add(candidate)
+                return candidate
+        logging.warning(f'Skipping {self.archive}:{name}: duplicate member name.')
+        return None
+
+class _SampleGrouper:
+    def __init__(self, archive: str, caption_extension: str) -> None:
+        self.archive = archive
+        self.caption_extension = f'.{caption_extension}'.upper()
+        self.keys = _KeyAllocator(archive)
+        self.key = None
+        self.images = []
+        self.caption = ''
+
+    def add(self, name: str, read) -> List[Sample]:
+        key = _split_key(name)
+        done = self.flush() if key != self.key else []
+        self.key = key
+        ext = _extension(name)
+        if ext in IMAGE_EXTENSIONS:
+            self.images.append((name, read()))
+        elif ext == self.caption_extension:
+            self.caption = read().decode('utf-8', errors='replace')
+        else:
+            logging.debug(f'Ignoring {self.archive}:{name}')
+        return done
+
+    def flush(self) -> List[Sample]:
+        samples = []
+        for name, data in self.images:
+            # A sample holding several images gets one caption per image
+            key = self.keys.key(self.key if len(self.images) == 1 else posixpath.splitext(name)[0], name)
+            if key is not None:
+                samples.append(Sample(self.archive, key, name, data, self.caption))
+        self.images = []
+        self.caption = ''
+        return samples
+
+def iter_tar(path: str, caption_extension: str = 'txt') -> Iterator[Sample]:
+    # 'r|*' opens the shard as a non-seekable stream: members are read strictly in order
+    # and nothing is extracted to disk.
+    grouper = _SampleGrouper(str(path), caption_extension)
+    with tarfile.open(path, 'r|*') as tar:
+        for info in tar:
+            if not info.isfile():
+                continue
+            yield from grouper.add(info.name, lambda: tar.extractfile(info).read())
+    yield from grouper.flush()
+
+def iter_zip(path: str, caption_extension: str = 'txt') -> Iterator[Sample]:
+    # Zips are random access, so each image is paired with its caption member by name wherever it is stored
+    caption_extension = f'.{caption_extension}'.upper()
+    keys = _KeyAllocator(str(path))
+    with zipfile.ZipFile(path) as zf:
+        members = [info for info in zf.infolist() if not info.is_dir()]
+        captions = {posixpath.splitext(info.filename)[0]: info for info in members if _extension(info.filename) == caption_extension}
+        # Sort by header offset so members are read front to back
+        for info in sorted(members, key=lambda i: i.header_offset):
+            if _extension(info.filename) not in IMAGE_EXTENSIONS:
+                continue
+            base = posixpath.splitext(info.filename)[0]
+            key = keys.key(base, info.filename)
+            if key is None:
+                continue
+            caption = captions.get(base) or captions.get(_split_key(info.filename))
+            existing = zf.read(caption).decode('utf-8', errors='replace') if caption is not None else ''
+            yield Sample(str(path), key, info.filename, zf.read(info), existing)
+
+def iter_archive(path, caption_extension: str = 'txt') -> Iterator[Sample]:
+    if str(path).upper().endswith('.ZIP'):
+        return iter_zip(path, caption_extension)
+    return iter_tar(path, caption_extension)
+
+_DONE = object()
+
+def _decode(data: bytes) -> Image.Image:
+    return Image.open(io.BytesIO(data)).convert('RGB')
+
+def iter_archives(paths: List, caption_extension: str = 'txt', workers: int = 4, prefetch: int = 64, decode=_decode) -> Iterator:
+    """Stream decoded samples from several shards at once.
+
+    Each shard is read and decoded by its own worker thread; samples are handed over through a
+    bounded queue so memory stays flat no matter how large the shards are. Yields
+    (sample, image, error) tuples, with image None and error set if the sample could not be decoded.
+    """
+    samples = queue.Queue(maxsize=prefetch)
+    pending = list(paths)
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            with lock:
+                if not pending:
+                    break
+                path = pending.pop(0)
+            try:
+                for sample in iter_archive(path, caption_extension):
+                    try:
+                        img = decode(sample.data)
+                        samples.put((sample, img, None))
+                    except Exception as e:
+                        samples.put((sample, None, e))
+            except Exception:
+                logging.exception(f"Exception occurred reading {path}")
+        samples.put(_DONE)
+
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(max(1, min(workers, len(pending))))]
+    for t in threads:
+        t.start()
+    running = len(threads)
+    while running:
+        item = samples.get()
+        if item is _DONE:
+            running -= 1
+            continue
+        yield item
+
+class ArchiveCaptionWriter:
+    """Writes captions for archive samples, keyed by member name.
+
+    mode 'sidecar' writes <output>/<shard name>/<key>.<ext> files, 'shard' writes a companion
+    <shard name>.captions.tar holding one <key>.<ext> member per sample.
+    """
+    def __init__(self, output, extension: str = 'txt', mode: str = 'sidecar') -> None:
+        self.output = output
+        self.extension = extension
+        self.mode = mode
+        self.tars = {}
+
+    def _shard_name(self, archive: str) -> str:
+        name = os.path.basename(archive)
+        for ext in ['.tar.gz', '.tar.bz2', '.tar.xz', '.tgz', '.tar', '.zip']:
+            if name.lower().endswith(ext):
+                return name[:-len(ext)]
+        return os.path.splitext(name)[0]
+
+    def _dirname(self, archive: str) -> str:
+        if self.output == '' or self.output is None:
+            return os.path.dirname(os.path.abspath(archive))
+        return str(self.output[0]) if isinstance(self.output, list) else str(self.output)
+
+    def _key(self, sample: Sample) -> str:
+        key = safe_key(sample.key)
+        if key is None:
+            raise ValueError(f'Refusing to write a caption for {sample.archive}:{sample.name} outside the output folder')
+        return key
+
+    def sidecar_path(self, sample: Sample) -> str:
+        return os.path.join(self._dirname(sample.archive), self._shard_name(sample.archive), f'{self._key(sample)}.{self.extension}')
+
+    def write(self, sample: Sample, caption: str) -> str:
+        if self.mode == 'shard':
+            path = os.path.join(self._dirname(sample.archive), f'{self._shard_name(sample.archive)}.captions.tar')
+            tar = self.tars.get(path)
+            if tar is None:
+                # Written under a private name and renamed into place on close, so a half-written tar is
+                # never visible and two nodes captioning the same shard cannot interleave their writes
+                tar = self.tars[path] = tarfile.open(f'{path}.{socket.gethostname()}-{os.getpid()}.tmp', 'w')
+            data = caption.encode('utf-8')
+            info = tarfile.TarInfo(f'{self._key(sample)}.{self.extension}')
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+            return f'{path}:{info.name}'
+
+        path = self.sidecar_path(sample)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w", encoding="utf8") as file:
+            file.write(caption)
+        return path
+
+    def close(self) -> None:
+        for path, tar in self.tars.items():
+            tar.close()
+            os.replace(tar.name, path)
+        self.tars = {}